@@ -0,0 +1,250 @@
+"""Answer a list of questions against the data, e.g.,
+
+    python cli/cli_batch.py --questions questions.txt --results results.jsonl --replicas 2
+
+The questions file has one question per line. Each answer is appended to the
+results file as soon as it is finished, so a rerun only answers the questions
+which have not been answered successfully.
+"""
+
+import argparse
+from base64 import b64decode
+from hashlib import sha256
+from json import dumps as json_dumps
+from json import loads as json_loads
+from multiprocessing import get_context
+from os import makedirs
+from os.path import exists, join
+from queue import Empty
+from shutil import copyfile
+from time import time
+
+from process.style.show_insight import cached_query_insight
+from process.wrapper import load_data_and_model
+
+# export PYTHONPATH=/home/zhangs/Github/Multiagents_tool
+data_and_model = None
+
+
+def get_example_usage():
+    return """
+Example usage:
+    python cli/cli_batch.py
+        --questions etc/questions.txt
+        --results etc/results/results.jsonl
+        --images etc/results/images
+        --llm_flag not_use_llm
+        --replicas 1
+"""
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description="Answer a list of questions against the data",
+        epilog=get_example_usage(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--questions", required=True, help="Questions file, one question per line"
+    )
+    parser.add_argument("--results", required=True, help="Results file (JSON lines)")
+    parser.add_argument(
+        "--images", default=None, help="Directory for the images (default: no images)"
+    )
+    parser.add_argument(
+        "--llm_flag",
+        choices=["use_llm", "not_use_llm"],
+        default="not_use_llm",
+        help="If the LLM is used to summarize the answers",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Number of processes, each loads its own copy of the models",
+    )
+    return parser.parse_args()
+
+
+def read_questions(questions_path: str) -> list:
+    """Read the questions, one per line
+
+    Args:
+        questions_path (str): questions file
+
+    Returns:
+        list: questions
+    """
+    with open(questions_path) as fid:
+        return [line.strip() for line in fid if line.strip()]
+
+
+def read_finished_questions(results_path: str) -> set:
+    """Read the questions which have been answered successfully
+
+    Args:
+        results_path (str): results file
+
+    Returns:
+        set: answered questions
+    """
+    finished_questions = set()
+    if not exists(results_path):
+        return finished_questions
+
+    with open(results_path) as fid:
+        for line in fid:
+            try:
+                result = json_loads(line)
+            except ValueError:
+                # e.g., the last line was not completed before a crash
+                continue
+            if result["error"] is None:
+                finished_questions.add(result["question"])
+
+    return finished_questions
+
+
+def _init_worker():
+    global data_and_model
+    data_and_model = load_data_and_model(background=False)
+
+
+def answer_question(question: str, llm_flag: str, images_dir: str) -> dict:
+    """Answer a question with the loaded data and model
+
+    Args:
+        question (str): question to be answered
+        llm_flag (str): use_llm or not_use_llm
+        images_dir (str): directory for the images, None to skip the images
+
+    Returns:
+        dict: result with the answer, pandas instruction, image path and timing
+    """
+    result = {
+        "question": question,
+        "response": None,
+        "pandas_instruction_str": None,
+        "image_path": None,
+        "error": None,
+    }
+
+    start_t = time()
+    try:
+        answer = cached_query_insight(llm_flag, question, data_and_model)
+    except Exception as e:
+        result["error"] = str(e)
+        answer = None
+    result["time"] = time() - start_t
+
+    if answer is not None:
+        result["response"] = answer["response"]
+        result["pandas_instruction_str"] = answer["pandas_instruction_str"]
+        if answer["image_src"] is not None and images_dir is not None:
+            result["image_path"] = join(
+                images_dir, f"{sha256(question.encode()).hexdigest()[:16]}.png"
+            )
+            if answer["image_src"].startswith("data:"):
+                with open(result["image_path"], "wb") as fid:
+                    fid.write(b64decode(answer["image_src"].split(",", 1)[1]))
+            else:
+                copyfile(
+                    data_and_model["plot_service"].image_path(answer["image_src"]),
+                    result["image_path"],
+                )
+
+    return result
+
+
+def _worker_main(jobs, results):
+    """Answer the jobs until None is received, the worker is not daemonic,
+    so it can start the code executor and plot service processes
+
+    Args:
+        jobs (Queue): questions, llm flags and image directories
+        results (Queue): results of the answered questions
+    """
+    _init_worker()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        results.put(answer_question(*job))
+
+
+def main(
+    questions_path: str,
+    results_path: str,
+    images_dir: str = None,
+    llm_flag: str = "not_use_llm",
+    replicas: int = 1,
+):
+    """Answer the questions and append the results
+
+    Args:
+        questions_path (str): questions file, one question per line
+        results_path (str): results file (JSON lines)
+        images_dir (str, optional): directory for the images. Defaults to None.
+        llm_flag (str, optional): use_llm or not_use_llm. Defaults to "not_use_llm".
+        replicas (int, optional): number of processes. Defaults to 1.
+    """
+    finished_questions = read_finished_questions(results_path)
+    questions = [
+        question
+        for question in read_questions(questions_path)
+        if question not in finished_questions
+    ]
+    print(f"{len(finished_questions)} questions have been answered ...")
+    print(f"{len(questions)} questions to be answered ...")
+    if len(questions) == 0:
+        return
+
+    if images_dir is not None:
+        makedirs(images_dir, exist_ok=True)
+
+    jobs = [(question, llm_flag, images_dir) for question in questions]
+
+    with open(results_path, "a") as fid:
+
+        def _write(result: dict):
+            fid.write(json_dumps(result) + "\n")
+            fid.flush()
+            print(f"{result['question']}: {result['time']:.1f} seconds ...")
+
+        if replicas == 1:
+            _init_worker()
+            for job in jobs:
+                _write(answer_question(*job))
+        else:
+            context = get_context("spawn")
+            job_queue, result_queue = context.Queue(), context.Queue()
+            for job in jobs + [None] * replicas:
+                job_queue.put(job)
+
+            workers = [
+                context.Process(target=_worker_main, args=(job_queue, result_queue))
+                for _ in range(replicas)
+            ]
+            for worker in workers:
+                worker.start()
+
+            pending = len(jobs)
+            while pending > 0:
+                try:
+                    result = result_queue.get(timeout=1.0)
+                except Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        raise Exception(
+                            f"The workers are stopped with {pending} questions left ..."
+                        )
+                    continue
+                _write(result)
+                pending -= 1
+
+            for worker in workers:
+                worker.join()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    main(args.questions, args.results, args.images, args.llm_flag, args.replicas)
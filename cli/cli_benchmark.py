@@ -0,0 +1,99 @@
+"""Benchmark the insight pipeline without the GGUF models, e.g.,
+
+    python cli/cli_benchmark.py --output benchmark.json --sizes 100 1000 10000
+
+The code model and LLM are replaced by deterministic stand-ins with
+configurable latency, and the data is a synthetic Leaft-like frame.
+"""
+
+import argparse
+from datetime import datetime
+from json import dump as json_dump
+from platform import platform, python_version
+from subprocess import CalledProcessError, check_output
+
+from process.benchmark import run_benchmark
+
+# export PYTHONPATH=/home/zhangs/Github/Multiagents_tool
+
+
+def get_example_usage():
+    return """
+Example usage:
+    python cli/cli_benchmark.py
+        --output etc/benchmark/benchmark.json
+        --sizes 100 1000 10000
+        --repeats 3
+        --code_latency 0.0
+        --token_latency 0.0
+"""
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the insight pipeline with stub models",
+        epilog=get_example_usage(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--output", required=True, help="Results file (JSON)")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Number of rows of the synthetic data",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of each stage")
+    parser.add_argument(
+        "--code_latency",
+        type=float,
+        default=0.0,
+        help="Seconds per code model generation",
+    )
+    parser.add_argument(
+        "--token_latency", type=float, default=0.0, help="Seconds per LLM token"
+    )
+    return parser.parse_args()
+
+
+def get_version() -> str:
+    try:
+        return check_output(
+            ["git", "describe", "--always", "--dirty"], text=True
+        ).strip()
+    except (CalledProcessError, OSError):
+        return "unknown"
+
+
+def main(
+    output_path: str,
+    sizes: list,
+    repeats: int,
+    code_latency: float,
+    token_latency: float,
+):
+    results = run_benchmark(sizes, repeats, code_latency, token_latency)
+
+    with open(output_path, "w") as fid:
+        json_dump(
+            {
+                "version": get_version(),
+                "time": datetime.now().isoformat(),
+                "platform": platform(),
+                "python": python_version(),
+                "settings": {
+                    "sizes": sizes,
+                    "repeats": repeats,
+                    "code_latency": code_latency,
+                    "token_latency": token_latency,
+                },
+                "results": results,
+            },
+            fid,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    main(args.output, args.sizes, args.repeats, args.code_latency, args.token_latency)
@@ -2,74 +2,192 @@
 # import dash_bootstrap_components as dbc
 # import dash_core_components as dcc
 # import dash_html_components as html
-from dash import State
+from uuid import uuid4
+
+from dash import State, ctx, no_update
 from dash.dependencies import Input, Output
 
 # from process import DASHBOARD_STYLE, LOCAL_MODEL_SETUPS
-from process.app import create_app
+from process import DATA_RELOAD, INFERENCE_SERVER
+from process.app import (
+    add_health_route,
+    add_metrics_route,
+    add_plot_route,
+    add_route_cookie,
+    create_app,
+)
 from process.style.show_hide_content import show_hide_content_ctl
-from process.style.show_insight import show_insight
-from process.style.show_table import render_table
+from process.style.show_insight import poll_insight, show_insight, submit_insight
+from process.style.show_table import render_table, update_table
 
 # from process.utils import create_img, replace_substrings
-from process.wrapper import load_data_and_model
+from process.watcher import DataWatcher
+from process.wrapper import load_data_and_model, select_dataset
 
 # from dash_table import DataTable
 
 
 # export PYTHONPATH=/home/zhangs/Github/Multiagents_tool
-app = create_app()
-data_and_model = load_data_and_model()
-
-
-@app.callback(
-    [
-        Output("data-container", "style"),
-        Output("output-container", "style"),
-        Output("prompt-container", "style"),
-        Output("submit-button", "style"),
-        Output("llm-radio", "style"),
-        Output(component_id="submit-button", component_property="n_clicks"),
-    ],
-    Input("tabs", "value"),
-)
-def show_hide_content_wrapper(selected_tab):
-    return show_hide_content_ctl(selected_tab)
 
 
-@app.callback(Output("data-container", "children"), Input("tabs", "value"))
-def render_content_wrapper(tab):
-    return render_table(tab, data_and_model)
+def register_callbacks(app, data_and_model: dict):
+    """Register the dashboard callbacks
 
+    Args:
+        app (Dash): dashboard app
+        data_and_model (dict): data and model being loaded
+    """
 
-@app.callback(
-    Output(component_id="llm-radio", component_property="children"),
-    Input(component_id="llm-radio", component_property="value"),
-    prevent_initial_call=True,
-)
-def update_llm_ratio_wrapper(llm_flag):
-    return llm_flag
-
-
-@app.callback(
-    [
-        Output(component_id="output-container", component_property="children"),
-        Output(
-            component_id="pandas-instruction-container", component_property="children"
-        ),
-    ],
-    Input("tabs", "value"),
-    Input(component_id="submit-button", component_property="n_clicks"),
-    [
-        State(component_id="llm-radio", component_property="value"),
-        State(component_id="prompt-container", component_property="value"),
-        State(component_id="output-container", component_property="children"),
-    ],
-    prevent_initial_call=True,
-)
-def update_output(tab, n_clicks, llm_flag, prompt, current_output):
-    return show_insight(tab, n_clicks, llm_flag, prompt, current_output, data_and_model)
+    @app.callback(
+        [
+            Output("data-container", "style"),
+            Output("output-container", "style"),
+            Output("prompt-container", "style"),
+            Output("submit-button", "style"),
+            Output("llm-radio", "style"),
+            Output(component_id="submit-button", component_property="n_clicks"),
+        ],
+        Input("tabs", "value"),
+    )
+    def show_hide_content_wrapper(selected_tab):
+        return show_hide_content_ctl(selected_tab)
+
+    @app.callback(
+        Output("data-container", "children"),
+        Input("tabs", "value"),
+        Input("dataset-dropdown", "value"),
+    )
+    def render_content_wrapper(tab, dataset):
+        return render_table(tab, select_dataset(data_and_model, dataset))
+
+    @app.callback(
+        Output("session-store", "data"),
+        Input("session-store", "data"),
+    )
+    def init_session(session_id):
+        return uuid4().hex if session_id is None else no_update
+
+    @app.callback(
+        [Output("table", "data"), Output("table", "page_count")],
+        Input("table", "page_current"),
+        Input("table", "page_size"),
+        Input("table", "filter_query"),
+        Input("table", "sort_by"),
+        State("dataset-dropdown", "value"),
+        prevent_initial_call=True,
+    )
+    def update_table_wrapper(page_current, page_size, filter_query, sort_by, dataset):
+        return update_table(
+            page_current,
+            page_size,
+            filter_query,
+            sort_by,
+            select_dataset(data_and_model, dataset),
+        )
+
+    @app.callback(
+        Output(component_id="llm-radio", component_property="children"),
+        Input(component_id="llm-radio", component_property="value"),
+        prevent_initial_call=True,
+    )
+    def update_llm_ratio_wrapper(llm_flag):
+        return llm_flag
+
+    @app.callback(
+        [
+            Output(component_id="output-container", component_property="children"),
+            Output(
+                component_id="pandas-instruction-container",
+                component_property="children",
+            ),
+            Output(component_id="job-store", component_property="data"),
+            Output(component_id="job-interval", component_property="disabled"),
+        ],
+        Input("tabs", "value"),
+        Input(component_id="submit-button", component_property="n_clicks"),
+        Input(component_id="job-interval", component_property="n_intervals"),
+        [
+            State(component_id="llm-radio", component_property="value"),
+            State(component_id="prompt-container", component_property="value"),
+            State(component_id="session-store", component_property="data"),
+            State(component_id="job-store", component_property="data"),
+            State(component_id="dataset-dropdown", component_property="value"),
+        ],
+        prevent_initial_call=True,
+    )
+    def update_output(
+        tab, n_clicks, n_intervals, llm_flag, prompt, session_id, job, dataset
+    ):
+        if data_and_model["job_queue"] is None:
+            return show_insight(
+                tab,
+                n_clicks,
+                llm_flag,
+                prompt,
+                session_id,
+                select_dataset(data_and_model, dataset),
+            ) + [None, True]
+
+        if ctx.triggered_id == "job-interval":
+            return poll_insight(job, session_id, data_and_model, tab)
+
+        return submit_insight(
+            tab,
+            n_clicks,
+            llm_flag,
+            prompt,
+            session_id,
+            select_dataset(data_and_model, dataset),
+            job,
+        )
+
+
+def create_dashboard(remote: bool = INFERENCE_SERVER["enable"]):
+    """Load the data and model and create the dashboard
+
+    The code executor and plot service start their workers with spawn, which
+    imports this script again in each worker, so nothing is loaded at import.
+
+    Args:
+        remote (bool, optional): if the models are served by the inference server
+            (see cli/cli_server.py). Defaults to INFERENCE_SERVER["enable"].
+
+    Returns:
+        Dash: dashboard app
+    """
+    app = create_app()
+    data_and_model = load_data_and_model(remote=remote)
+    add_health_route(app, data_and_model)
+    add_plot_route(app)
+    add_metrics_route(app, data_and_model)
+    add_route_cookie(app)
+    register_callbacks(app, data_and_model)
+    if DATA_RELOAD["enable"]:
+        DataWatcher(data_and_model).start()
+    return app
+
+
+def create_server():
+    """WSGI app factory of a dashboard worker, which uses the models of the
+    inference server instead of loading them, e.g.,
+
+        gunicorn -w 1 --threads 8 -b 127.0.0.1:8061 "cli_dash:create_server()"
+
+    Returns:
+        Flask: WSGI app
+    """
+    return create_dashboard(remote=True).server
+
+
+def main(host: str = "0.0.0.0", port: int = 8050):
+    """Run the dashboard with the development server
+
+    Args:
+        host (str, optional): host to listen on. Defaults to "0.0.0.0".
+        port (int, optional): port to listen on. Defaults to 8050.
+    """
+    create_dashboard().run_server(host=host, port=port)
 
 
 if __name__ == "__main__":
-    app.run_server(host="0.0.0.0", port=8050)
+    main()
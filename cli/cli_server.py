@@ -0,0 +1,70 @@
+"""Run the local inference server keeping one copy of the code model and the LLM, e.g.,
+
+    python cli/cli_server.py --host 127.0.0.1 --port 8051
+
+Set INFERENCE_SERVER["enable"] (process/__init__.py) to True, so the dashboard
+workers call the server instead of loading the models themselves.
+"""
+
+import argparse
+
+from process import INFERENCE_SERVER, MODEL_ROUTING
+from process.model import (
+    load_code_model_local,
+    load_llm_model_local,
+    load_small_code_model_local,
+)
+from process.server import InferenceServer, create_server
+
+# export PYTHONPATH=/home/zhangs/Github/Multiagents_tool
+
+
+def get_example_usage():
+    return """
+Example usage:
+    python cli/cli_server.py
+        --host 127.0.0.1
+        --port 8051
+        --batch_size 8
+"""
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description="Serve the code model and the LLM to the dashboard workers",
+        epilog=get_example_usage(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8051, help="Port to listen on")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=INFERENCE_SERVER["batch_size"],
+        help="Maximum requests in a batch",
+    )
+    parser.add_argument(
+        "--batch_wait",
+        type=float,
+        default=INFERENCE_SERVER["batch_wait"],
+        help="Seconds to wait for more requests of a batch",
+    )
+    return parser.parse_args()
+
+
+def main(host: str, port: int, batch_size: int, batch_wait: float):
+    inference_server = InferenceServer(
+        code_model=load_code_model_local(),
+        llm_model=load_llm_model_local(),
+        small_code_model=(
+            load_small_code_model_local() if MODEL_ROUTING["enable"] else None
+        ),
+        batch_size=batch_size,
+        batch_wait=batch_wait,
+    )
+    create_server(inference_server).run(host=host, port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    main(args.host, args.port, args.batch_size, args.batch_wait)
@@ -0,0 +1,119 @@
+"""Find the fastest llama.cpp settings of a model on this machine, e.g.,
+
+    python cli/cli_tune.py --model code_model --threads 8 16 --batches 256 512
+
+The prefill and decode throughput of each thread, batch and context setting
+is measured, and the fastest profile is saved to RUNTIME_PROFILES["path"],
+which the loaders use with the auto profile.
+"""
+
+import argparse
+from os import cpu_count
+
+from process import LOCAL_MODEL_SETUPS, RUNTIME_PROFILES
+from process.runtime import (
+    get_runtime_profile,
+    save_runtime_profile,
+    tune_runtime_profile,
+)
+
+# export PYTHONPATH=/home/zhangs/Github/Multiagents_tool
+
+
+def get_example_usage():
+    return """
+Example usage:
+    python cli/cli_tune.py
+        --model code_model
+        --threads 8 16
+        --batches 256 512
+        --contexts 5000
+        --prompt_tokens 1024
+        --decode_tokens 32
+"""
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description="Tune the llama.cpp runtime profile of a model",
+        epilog=get_example_usage(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--model",
+        default="code_model",
+        choices=["code_model", "small_code_model", "llm"],
+        help="Model to be tuned",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=sorted({max(1, cpu_count() // 2), cpu_count()}),
+        help="Numbers of threads",
+    )
+    parser.add_argument(
+        "--batches", type=int, nargs="+", default=[256, 512], help="Batch sizes"
+    )
+    parser.add_argument(
+        "--contexts",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Context sizes, defaults to the one of the current profile",
+    )
+    parser.add_argument("--prompt_tokens", type=int, default=1024, help="Prompt length")
+    parser.add_argument(
+        "--decode_tokens", type=int, default=32, help="Generated tokens"
+    )
+    parser.add_argument(
+        "--min_ctx",
+        type=int,
+        default=None,
+        help='Minimum context size, defaults to RUNTIME_PROFILES["min_ctx"]',
+    )
+    parser.add_argument(
+        "--output", default=RUNTIME_PROFILES["path"], help="Profile file (JSON)"
+    )
+    return parser.parse_args()
+
+
+def main(
+    model: str,
+    threads: list,
+    batches: list,
+    contexts: list,
+    prompt_tokens: int,
+    decode_tokens: int,
+    min_ctx: int,
+    output_path: str,
+):
+    if contexts is None:
+        contexts = [get_runtime_profile(model)["n_ctx"]]
+
+    profile, results = tune_runtime_profile(
+        model,
+        LOCAL_MODEL_SETUPS[model]["path"],
+        threads,
+        batches,
+        contexts,
+        prompt_tokens,
+        decode_tokens,
+        min_ctx,
+    )
+    save_runtime_profile(model, profile, results, output_path)
+    print(f"The fastest profile of {model} is saved to {output_path}: {profile}")
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    main(
+        args.model,
+        args.threads,
+        args.batches,
+        args.contexts,
+        args.prompt_tokens,
+        args.decode_tokens,
+        args.min_ctx,
+        args.output,
+    )
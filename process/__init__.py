@@ -1,5 +1,122 @@
 DATA_PATH = {"leaft": "etc/data/leaft_data_v2.0.xlsx"}
 
+# datasets to be chosen on the dashboard, a dataset is a sheet of a workbook
+DATASETS = {
+    "leaft": {
+        "label": "Leaft: Full. Crop -> Juice -> Final",
+        "path": DATA_PATH["leaft"],
+        "sheet": "Full. Crop -> Juice -> Final",
+    },
+}
+
+# the default dataset is always kept, the others are loaded on first use, the
+# idle ones are checked every evict_interval seconds
+DATASET_REGISTRY = {
+    "default": "leaft",
+    "max_datasets": 2,
+    "max_memory": 2 * 1024**3,
+    "idle_time": 1800.0,
+    "evict_interval": 60.0,
+}
+
+DATA_CACHE = {"enable": True, "dir": "etc/cache/data", "hash": False}
+
+DATA_SCHEMA = {"category_ratio": 0.5}
+
+ANSWER_CACHE = {"enable": True, "size": 256, "path": "etc/cache/answers.sqlite"}
+
+SEMANTIC_CACHE = {"enable": True, "threshold": 0.95, "size": 512}
+
+# simple aggregate questions are answered with pandas without the code model
+QUERY_PLANNER = {"enable": True}
+
+# the code model gets a schema summary of the data (types, units, ranges and
+# examples) instead of df.head(), with select_columns only the columns relevant
+# to the question are kept, units are taken from the column names if not set
+PROMPT_CONTEXT = {
+    "enable": True,
+    "max_tokens": 600,
+    "examples": 3,
+    "select_columns": False,
+    "max_columns": 12,
+    "units": {},
+}
+
+# try the small code model first, and the code model if its instruction fails,
+# LOCAL_MODEL_SETUPS["small_code_model"] must be available to enable it
+MODEL_ROUTING = {"enable": False}
+
+# after loading, the model weights are read into the page cache ("touch") or
+# locked in memory while loading ("mlock"), each model answers a canned question
+# and a plot is rendered; /health reports ready after it, disable it for a faster
+# cold boot
+WARM_UP = {"enable": True, "weights": "touch", "max_tokens": 8, "plot": True}
+
+MODEL_LOADING = {"background": True, "workers": 4}
+
+# the changed workbooks are read again in the background, the old data is
+# released when the requests in flight are done with it, or after grace_time
+DATA_RELOAD = {
+    "enable": True,
+    "interval": 5.0,
+    "grace_time": 300.0,
+    "required_columns": ["Trial"],
+}
+
+# the workers share the numeric columns of an uncompressed Arrow file in dir, the
+# other columns are copied into each worker, memory bounds the rest of a worker
+CODE_EXECUTOR = {
+    "enable": True,
+    "workers": 2,
+    "timeout": 30.0,
+    "cpu_time": 20,
+    "memory": 4 * 1024**3,
+    "dir": "/dev/shm",
+}
+
+PLOT_SERVICE = {
+    "enable": True,
+    "workers": 2,
+    "dir": "etc/cache/plots",
+    "url": "/plots/",
+}
+
+DATA_TABLE = {"page_size": 50, "view_size": 32}
+
+HISTORY = {"size": 50, "sessions": 1000}
+
+METRICS = {
+    "prefix": "insight",
+    "buckets": [0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0],
+    # the histograms which are not latencies in seconds
+    "metric_buckets": {
+        "llm_tokens_per_second": [1, 2, 5, 10, 20, 50, 100, 200],
+        "inference_batch_size": [1, 2, 4, 8, 16, 32],
+    },
+    "trace_log": None,
+}
+
+JOB_QUEUE = {
+    "enable": True,
+    "workers": 2,
+    "max_jobs": 1000,
+    "max_depth": 32,
+    "poll_interval": 1000,
+}
+
+# one process keeps the code model and the LLM, the web workers call it over HTTP
+INFERENCE_SERVER = {
+    "enable": False,
+    "url": "http://127.0.0.1:8051",
+    "batch_size": 8,
+    "batch_wait": 0.01,
+    "timeout": 300.0,
+}
+
+# the jobs and conversations are kept in each dashboard worker, so with several
+# workers a proxy must route a browser to the same one by this cookie (see README)
+WEB_WORKERS = {"route_cookie": "insight_route", "max_age": 30 * 24 * 3600}
+
 
 DASHBOARD_STYLE = {
     "title": {
@@ -14,6 +131,7 @@ DASHBOARD_STYLE = {
         }
     },
     "tab-container": {"style": {"width": "700px", "display": "inline-block"}},
+    "dataset-dropdown": {"style": {"width": "700px", "margin": "10px 0"}},
     "tabs": {
         "style": {
             "default": {
@@ -137,13 +255,99 @@ DASHBOARD_STYLE = {
 }
 
 
+# llama.cpp runtime settings of each model, "auto" uses the profile saved by
+# cli/cli_tune.py if any, otherwise the gpu (if supported) or cpu profile,
+# cli/cli_tune.py does not go below min_ctx, the context the prompts need
+RUNTIME_PROFILES = {
+    "profile": "auto",
+    "path": "etc/runtime_profile.json",
+    "min_ctx": {"code_model": 5000, "small_code_model": 5000, "llm": 512},
+    "cpu": {
+        "code_model": {
+            "n_gpu_layers": 0,
+            "n_ctx": 5000,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+        "small_code_model": {
+            "n_gpu_layers": 0,
+            "n_ctx": 5000,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+        "llm": {
+            "n_gpu_layers": 0,
+            "n_ctx": 512,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+    },
+    "gpu": {
+        "code_model": {
+            "n_gpu_layers": 30,
+            "n_ctx": 5000,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+        "small_code_model": {
+            "n_gpu_layers": -1,
+            "n_ctx": 5000,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+        "llm": {
+            "n_gpu_layers": 0,
+            "n_ctx": 512,
+            "n_threads": None,
+            "n_batch": 512,
+            "use_mmap": True,
+            "use_mlock": False,
+        },
+    },
+}
+
 LOCAL_MODEL_SETUPS = {
     "embedding_model": {"path": "etc/models/BAAI"},
-    "code_model": {"path": "etc/models/CodeLlama-34b-Instruct.gguf"},
+    "code_model": {
+        "path": "etc/models/CodeLlama-34b-Instruct.gguf",
+        # llama.cpp states of the prompt prefixes, type in ram, disk or None
+        "prompt_cache": {
+            "cache_type": "ram",
+            "capacity": 4 << 30,
+            "cache_dir": "etc/cache/llama/code_model",
+        },
+    },
+    "small_code_model": {
+        "path": "etc/models/CodeLlama-7b-Instruct.Q4_K_M.gguf",
+        "prompt_cache": {
+            "cache_type": "ram",
+            "capacity": 1 << 30,
+            "cache_dir": "etc/cache/llama/small_code_model",
+        },
+    },
     "llm": {
         "path": "etc/models/Meta-Llama-3-8B-Instruct.gguf",
         "prompt_template": "The question is {prompt} The answer as '{response}'. "
         + "Combine the question and answer and give one definte sentence. "
         + "Strickly no extra other texts beyond this sentence.",
+        # one sentence without quotes, decimals are allowed
+        "grammar": 'root ::= [^\\n."] ([^\\n."] | "." [0-9])* "."',
+        "max_tokens": 100,
+        "timeout": 10.0,
+        "prompt_cache": {
+            "cache_type": "ram",
+            "capacity": 1 << 30,
+            "cache_dir": "etc/cache/llama/llm",
+        },
     },
 }
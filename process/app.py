@@ -1,13 +1,35 @@
+from os.path import abspath
+from time import time
+from uuid import uuid4
+
 from dash import Dash
 from dash_bootstrap_components import Col, Container, Row
-from dash_core_components import Graph, Input, Interval, RadioItems, Tab, Tabs
+from dash_core_components import (
+    Dropdown,
+    Graph,
+    Input,
+    Interval,
+    RadioItems,
+    Store,
+    Tab,
+    Tabs,
+)
 from dash_html_components import H1, Button, Div
+from flask import Response, g, jsonify, request, send_from_directory
 
-from process import DASHBOARD_STYLE
+from process import (
+    DASHBOARD_STYLE,
+    DATASET_REGISTRY,
+    DATASETS,
+    JOB_QUEUE,
+    PLOT_SERVICE,
+    WEB_WORKERS,
+)
+from process.metrics import metrics
 
 
 def create_app():
-    app = Dash(__name__)
+    app = Dash(__name__, suppress_callback_exceptions=True)
 
     app.layout = Container(
         [
@@ -49,6 +71,18 @@ def create_app():
                     )
                 ],
             ),
+            Div(
+                Dropdown(
+                    id="dataset-dropdown",
+                    options=[
+                        {"label": dataset["label"], "value": name}
+                        for name, dataset in DATASETS.items()
+                    ],
+                    value=DATASET_REGISTRY["default"],
+                    clearable=False,
+                ),
+                style=DASHBOARD_STYLE["dataset-dropdown"]["style"],
+            ),
             Div(id="tabs-content"),
             Row(
                 [
@@ -80,6 +114,7 @@ def create_app():
                     ),
                     Col(
                         id="output-container",
+                        children=[],
                         width=DASHBOARD_STYLE["output-container"]["width"],
                         style=DASHBOARD_STYLE["output-container"]["style"].update(
                             {"display": "none"}
@@ -113,8 +148,121 @@ def create_app():
                 children=[],  # You can add content here dynamically
                 style={"margin-top": "20px"},  # Adjust styling as needed
             ),
+            Store(id="session-store", storage_type="session"),
+            Store(id="job-store"),
+            Interval(
+                id="job-interval",
+                interval=JOB_QUEUE["poll_interval"],
+                disabled=True,
+            ),
         ],
         fluid=True,
     )
 
     return app
+
+
+def add_health_route(app, data_and_model: dict):
+    """Add the /health route reporting the readiness
+    and loading time of each data and model component
+
+    Args:
+        app (Dash): dashboard app
+        data_and_model (dict): data and model being loaded
+    """
+
+    @app.server.route("/health")
+    def health():
+        status = data_and_model["status"]
+        ready = all(component["ready"] for component in status.values())
+        return jsonify({"ready": ready, "components": status}), 200 if ready else 503
+
+
+def add_route_cookie(
+    app,
+    cookie: str = WEB_WORKERS["route_cookie"],
+    max_age: int = WEB_WORKERS["max_age"],
+):
+    """Give each browser a random cookie, so a proxy in front of several
+    dashboard workers sends its requests to the worker keeping its jobs and
+    conversation (e.g., nginx "hash $cookie_insight_route consistent")
+
+    Args:
+        app (Dash): dashboard app
+        cookie (str, optional): cookie name. Defaults to WEB_WORKERS["route_cookie"].
+        max_age (int, optional): cookie lifetime in seconds. Defaults to WEB_WORKERS["max_age"].
+    """
+
+    @app.server.after_request
+    def set_route_cookie(response):
+        if cookie not in request.cookies:
+            response.set_cookie(
+                cookie, uuid4().hex, max_age=max_age, httponly=True, samesite="Lax"
+            )
+        return response
+
+
+def add_plot_route(
+    app,
+    plot_dir: str = PLOT_SERVICE["dir"],
+    plot_url: str = PLOT_SERVICE["url"],
+):
+    """Add the route serving the images rendered by the plot services
+    (one subdirectory per dataset)
+
+    Args:
+        app (Dash): dashboard app
+        plot_dir (str, optional): directory of the images. Defaults to PLOT_SERVICE["dir"].
+        plot_url (str, optional): URL prefix of the images. Defaults to PLOT_SERVICE["url"].
+    """
+
+    @app.server.route(f"{plot_url}<path:plot_name>")
+    def plot(plot_name):
+        return send_from_directory(abspath(plot_dir), plot_name, mimetype="image/png")
+
+
+def add_metrics_route(app, data_and_model: dict):
+    """Add the /metrics route (Prometheus text format) with the stage latency,
+    the LLM tokens, the cache counters and the Dash callback requests
+
+    Args:
+        app (Dash): dashboard app
+        data_and_model (dict): data and model being loaded
+    """
+
+    @app.server.before_request
+    def start_request_timer():
+        g.request_start_t = time()
+
+    @app.server.after_request
+    def record_request_time(response):
+        if request.path == "/_dash-update-component":
+            metrics.record("dash_request", time() - g.request_start_t)
+        return response
+
+    @app.server.route("/metrics")
+    def metrics_route():
+        gauges = {}
+        for component, status in data_and_model["status"].items():
+            gauges[("component_ready", (("component", component),))] = int(
+                status["ready"]
+            )
+        for cache_name in ["answer_cache", "semantic_cache"]:
+            if data_and_model[cache_name] is not None:
+                for key, value in data_and_model[cache_name].stats.items():
+                    gauges[(f"{cache_name}_{key}", ())] = value
+        for key, value in data_and_model["summary_stats"].items():
+            gauges[(f"summary_{key}", ())] = value
+        planner_stats = data_and_model["planner_stats"]
+        for key, value in planner_stats.items():
+            gauges[(f"planner_{key}", ())] = value
+        gauges[("planner_hit_rate", ())] = planner_stats["hits"] / max(
+            1, planner_stats["hits"] + planner_stats["misses"]
+        )
+        if data_and_model["job_queue"] is not None:
+            for key, value in data_and_model["job_queue"].stats.items():
+                gauges[(f"jobs_{key}", ())] = value
+        for key, value in data_and_model["datasets"].stats.items():
+            gauges[(f"datasets_{key}", ())] = value
+
+        return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
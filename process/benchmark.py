@@ -0,0 +1,317 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from typing import Any
+
+import numpy as np
+from llama_index.core import MockEmbedding
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+from pandas import DataFrame, ExcelWriter
+
+import process.wrapper as wrapper
+from process import ANSWER_CACHE, DATA_CACHE, PLOT_SERVICE, SEMANTIC_CACHE
+from process.data import read_leaft_data
+from process.style.show_insight import plan_insight, query_insight, show_insight
+from process.style.show_table import render_table, update_table
+from process.utils import create_img
+
+# question, pandas instruction and answer of the stub models
+BENCHMARK_QUESTIONS = [
+    (
+        "What is the mean R.DM.Sep",
+        "df['R.DM.Sep'].mean()",
+        "The mean R.DM.Sep is 0.5.",
+    ),
+    (
+        "What is the max PurifiedRCP/JuiceDM by Trial",
+        "df.groupby('Trial', observed=True)['PurifiedRCP/JuiceDM'].max()",
+        "The max PurifiedRCP/JuiceDM is 0.9.",
+    ),
+    (
+        "Plot R.DM.Sep against PurifiedRCP/JuiceDM",
+        "df.plot(x='R.DM.Sep', y='PurifiedRCP/JuiceDM', kind='scatter')",
+        "",
+    ),
+]
+
+
+class StubCodeModel(CustomLLM):
+    """Deterministic stand-in of the code model (see load_code_model_local):
+    answers the benchmark questions with the canned pandas instructions
+    """
+
+    latency: float = 0.0
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="stub-code-model")
+
+    def _get_instruction(self, prompt: str) -> str:
+        for question, pandas_instruction_str, _ in BENCHMARK_QUESTIONS:
+            if question in prompt:
+                return pandas_instruction_str
+        return "df.shape"
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        sleep(self.latency)
+        return CompletionResponse(text=self._get_instruction(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        sleep(self.latency)
+        text = self._get_instruction(prompt)
+        yield CompletionResponse(text=text, delta=text)
+
+
+class StubLLM:
+    """Deterministic stand-in of the llama.cpp LLM (see load_llm_model_local):
+    answers the benchmark questions with the canned sentences, token by token
+    """
+
+    def __init__(self, token_latency: float = 0.0):
+        """Initialize the stub LLM
+
+        Args:
+            token_latency (float, optional): seconds per generated token. Defaults to 0.0.
+        """
+        self.token_latency = token_latency
+
+    def _generate(self, prompt: str, max_tokens: int):
+        text = "The answer is 0."
+        for question, _, answer in BENCHMARK_QUESTIONS:
+            if question in prompt:
+                text = answer
+        tokens = [f" {token}" for token in text.split()][:max_tokens]
+
+        for i, token in enumerate(tokens):
+            sleep(self.token_latency)
+            yield {
+                "choices": [
+                    {
+                        "text": token,
+                        "finish_reason": "stop" if i == len(tokens) - 1 else None,
+                    }
+                ]
+            }
+
+    def __call__(
+        self, prompt: str, max_tokens: int = 16, stream: bool = False, **kwargs
+    ):
+        outputs = self._generate(prompt, max_tokens)
+        if stream:
+            return outputs
+        return {
+            "choices": [
+                {
+                    "text": "".join(output["choices"][0]["text"] for output in outputs),
+                    "finish_reason": "stop",
+                }
+            ]
+        }
+
+
+def make_leaft_data(rows: int, seed: int = 0) -> DataFrame:
+    """Create a synthetic Leaft-like data
+
+    Args:
+        rows (int): number of rows
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        DataFrame: synthetic data
+    """
+    rng = np.random.default_rng(seed)
+    return DataFrame(
+        {
+            "Trial": [f"Trial {i % 20}" for i in range(rows)],
+            "Crop": rng.choice(["Clover", "Kale", "Lucerne"], rows),
+            "R.DM.Sep": rng.random(rows),
+            "PurifiedRCP/JuiceDM": rng.random(rows),
+            "JuiceDM": rng.random(rows) * 10.0,
+            "FinalDM": rng.integers(0, 100, rows),
+        }
+    )
+
+
+def _time_it(func, repeats: int) -> dict:
+    # the first run is not timed, it starts the worker processes and fills
+    # the lazy caches (e.g., the executor spawn)
+    func()
+
+    times = []
+    for _ in range(repeats):
+        start_t = time()
+        func()
+        times.append(time() - start_t)
+    return {
+        "repeats": repeats,
+        "mean": float(np.mean(times)),
+        "median": float(np.median(times)),
+        "min": float(np.min(times)),
+        "max": float(np.max(times)),
+    }
+
+
+def load_stub_data_and_model(
+    df: DataFrame, code_latency: float, token_latency: float
+) -> dict:
+    """Load data and model as load_data_and_model, but with the stub models
+
+    Args:
+        df (DataFrame): data to be used
+        code_latency (float): seconds per code model generation
+        token_latency (float): seconds per LLM token
+
+    Returns:
+        dict: loaded data and model
+    """
+    loaders = {
+        "read_data": lambda data_type="leaft": df,
+        "load_embedding_model_local": lambda: MockEmbedding(embed_dim=8),
+        "load_code_model_local": lambda: StubCodeModel(latency=code_latency),
+        "load_small_code_model_local": lambda: StubCodeModel(latency=code_latency),
+        "load_llm_model_local": lambda: StubLLM(token_latency=token_latency),
+    }
+    original_loaders = {name: getattr(wrapper, name) for name in loaders}
+    # the pipeline is measured without the answer, image and data caches, which
+    # would also expire the persistent caches of the dashboard
+    configs = [ANSWER_CACHE, SEMANTIC_CACHE, PLOT_SERVICE, DATA_CACHE]
+    original_enables = [config["enable"] for config in configs]
+
+    try:
+        for name, loader in loaders.items():
+            setattr(wrapper, name, loader)
+        for config in configs:
+            config["enable"] = False
+        data_and_model = wrapper.load_data_and_model(background=False, warm_start=False)
+    finally:
+        for name, loader in original_loaders.items():
+            setattr(wrapper, name, loader)
+        for config, enable in zip(configs, original_enables):
+            config["enable"] = enable
+
+    return data_and_model
+
+
+def run_benchmark(
+    sizes: list = [100, 1000, 10000],
+    repeats: int = 3,
+    code_latency: float = 0.0,
+    token_latency: float = 0.0,
+) -> list:
+    """Benchmark the insight pipeline with the stub models
+
+    Args:
+        sizes (list, optional): number of rows of the synthetic data. Defaults to [100, 1000, 10000].
+        repeats (int, optional): timed repeats of each measurement, after an
+            untimed warm-up run. Defaults to 3.
+        code_latency (float, optional): seconds per code model generation. Defaults to 0.0.
+        token_latency (float, optional): seconds per LLM token. Defaults to 0.0.
+
+    Returns:
+        list: timing of each stage and data size
+    """
+    results = []
+
+    def _add_result(stage: str, rows: int, func):
+        result = {"stage": stage, "rows": rows, **_time_it(func, repeats)}
+        print(f"{stage} ({rows} rows): {result['median']:.4f} seconds ...")
+        results.append(result)
+
+    for rows in sizes:
+        df = make_leaft_data(rows)
+
+        with TemporaryDirectory() as tmp_dir:
+            data_path = join(tmp_dir, "leaft.xlsx")
+            with ExcelWriter(data_path) as writer:
+                df.to_excel(
+                    writer, sheet_name="Full. Crop -> Juice -> Final", index=False
+                )
+                df.to_excel(writer, sheet_name="Other", index=False)
+
+            _add_result(
+                "read_data",
+                rows,
+                lambda: read_leaft_data(data_path, excludes=None),
+            )
+            read_leaft_data(data_path, excludes=None, cache_dir=tmp_dir)
+            _add_result(
+                "read_data_cached",
+                rows,
+                lambda: read_leaft_data(data_path, excludes=None, cache_dir=tmp_dir),
+            )
+
+        data_and_model = load_stub_data_and_model(df, code_latency, token_latency)
+
+        try:
+            for question, pandas_instruction_str, _ in BENCHMARK_QUESTIONS:
+                if "plot" in pandas_instruction_str:
+                    _add_result(
+                        "create_img",
+                        rows,
+                        lambda: create_img(
+                            data_and_model["data"], pandas_instruction_str, False
+                        ),
+                    )
+                else:
+                    _add_result(
+                        "query_engine",
+                        rows,
+                        lambda: data_and_model["query_engine"].query(question),
+                    )
+                    _add_result(
+                        "query_planner",
+                        rows,
+                        lambda: plan_insight(question, data_and_model),
+                    )
+
+                for llm_flag in ["not_use_llm", "use_llm"]:
+                    _add_result(
+                        f"query_insight ({llm_flag})",
+                        rows,
+                        lambda: query_insight(llm_flag, question, data_and_model),
+                    )
+                    _add_result(
+                        f"show_insight ({llm_flag})",
+                        rows,
+                        lambda: show_insight(
+                            "tab-data-insight",
+                            1,
+                            llm_flag,
+                            question,
+                            "benchmark",
+                            data_and_model,
+                        ),
+                    )
+
+            _add_result(
+                "render_table",
+                rows,
+                lambda: render_table("tab-data", data_and_model),
+            )
+            _add_result(
+                "update_table",
+                rows,
+                lambda: update_table(
+                    1,
+                    50,
+                    "{R.DM.Sep} > 0.5",
+                    [{"column_id": "JuiceDM", "direction": "desc"}],
+                    data_and_model,
+                ),
+            )
+        finally:
+            for service in ["executor", "plot_service"]:
+                if data_and_model[service] is not None:
+                    data_and_model[service].shutdown()
+
+    return results
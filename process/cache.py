@@ -0,0 +1,318 @@
+from collections import OrderedDict
+from functools import lru_cache
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import makedirs
+from os.path import dirname
+from re import compile as re_compile
+from re import escape
+from sqlite3 import connect
+from threading import Lock
+
+import numpy as np
+
+from process import ANSWER_CACHE, SEMANTIC_CACHE
+from process.planner import AGGREGATIONS
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt so that trivially different prompts share the same answer,
+    e.g., extra white spaces or the ending question mark
+
+    Args:
+        prompt (str): prompt to be normalized
+
+    Returns:
+        str: normalized prompt
+    """
+    return " ".join(prompt.split()).rstrip("?.! ")
+
+
+@lru_cache(maxsize=32)
+def _terms_pattern(columns: tuple):
+    """Get the pattern of the column names and aggregation words"""
+    terms = "|".join(
+        escape(term)
+        for term in sorted(set(columns) | set(AGGREGATIONS), key=len, reverse=True)
+    )
+    return re_compile(f"(?<!\\w)(?:{terms})(?!\\w)")
+
+
+def prompt_terms(prompt: str, columns) -> frozenset:
+    """Get the column names and aggregations mentioned in a prompt, the prompts
+    which are close but differ in them have different answers, e.g., "mean
+    R.DM.Sep" and "max R.DM.Sep"
+
+    Args:
+        prompt (str): user prompt
+        columns (Index): columns of the data
+
+    Returns:
+        frozenset: lowercase column names and aggregation methods of the prompt
+    """
+    columns = tuple(sorted({col.lower() for col in columns if isinstance(col, str)}))
+    return frozenset(
+        AGGREGATIONS.get(term, term)
+        for term in _terms_pattern(columns).findall(normalize_prompt(prompt).lower())
+    )
+
+
+class AnswerCache:
+    """Two-level answer cache: an in-process LRU in front of a sqlite store.
+
+    Answers are keyed by the normalized prompt, the llm_flag and the data version,
+    so an answer is never reused for a different dataset.
+    """
+
+    def __init__(
+        self,
+        size: int = ANSWER_CACHE["size"],
+        db_path: str = ANSWER_CACHE["path"],
+    ):
+        """Initialize the answer cache
+
+        Args:
+            size (int, optional): maximum entries in the in-process LRU.
+                Defaults to ANSWER_CACHE["size"].
+            db_path (str, optional): sqlite file for the persistent store,
+                None to disable it. Defaults to ANSWER_CACHE["path"].
+        """
+        self.size = size
+        self.db_path = db_path
+        self.lru = OrderedDict()
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+        if self.db_path is not None:
+            makedirs(dirname(self.db_path) or ".", exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS answers ("
+                    "prompt TEXT, llm_flag TEXT, data_version TEXT, answer TEXT, "
+                    "PRIMARY KEY (prompt, llm_flag, data_version))"
+                )
+
+    def _connect(self):
+        return connect(self.db_path, timeout=30)
+
+    def get(self, prompt: str, llm_flag: str, data_version: str):
+        """Get a cached answer
+
+        Args:
+            prompt (str): user prompt
+            llm_flag (str): llm mode, e.g., use_llm
+            data_version (str): fingerprint of the loaded data
+
+        Returns:
+            dict: cached answer, None if not found
+        """
+        key = (normalize_prompt(prompt), llm_flag, data_version)
+
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.lru[key]
+
+        answer = None
+        if self.db_path is not None:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT answer FROM answers "
+                    "WHERE prompt = ? AND llm_flag = ? AND data_version = ?",
+                    key,
+                ).fetchone()
+            if row is not None:
+                answer = json_loads(row[0])
+                self._add_lru(key, answer)
+
+        with self.lock:
+            self.stats["hits" if answer is not None else "misses"] += 1
+
+        return answer
+
+    def set(self, prompt: str, llm_flag: str, data_version: str, answer: dict):
+        """Add an answer to the cache
+
+        Args:
+            prompt (str): user prompt
+            llm_flag (str): llm mode, e.g., use_llm
+            data_version (str): fingerprint of the loaded data
+            answer (dict): answer, e.g., pandas_instruction_str, response and image_src
+        """
+        key = (normalize_prompt(prompt), llm_flag, data_version)
+        self._add_lru(key, answer)
+
+        if self.db_path is not None:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)",
+                    key + (json_dumps(answer),),
+                )
+
+    def _add_lru(self, key: tuple, answer: dict):
+        with self.lock:
+            self.lru[key] = answer
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.size:
+                self.lru.popitem(last=False)
+
+    def expire(self, data_version: str):
+        """Remove the answers of a replaced data version. The store is shared by
+        all the datasets, so the answers of the other versions are kept.
+
+        Args:
+            data_version (str): fingerprint of the replaced data
+        """
+        with self.lock:
+            for key in [key for key in self.lru if key[2] == data_version]:
+                self.lru.pop(key)
+
+        if self.db_path is not None:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM answers WHERE data_version = ?", (data_version,)
+                )
+
+
+class SemanticCache:
+    """Vector index of past prompts and their pandas instructions.
+
+    A new prompt close enough (cosine similarity) to a past one, and with the
+    same columns and aggregations (see prompt_terms), reuses its pandas
+    instruction, so the code model does not need to be called.
+    """
+
+    def __init__(
+        self,
+        embed_model,
+        threshold: float = SEMANTIC_CACHE["threshold"],
+        size: int = SEMANTIC_CACHE["size"],
+    ):
+        """Initialize the semantic cache
+
+        Args:
+            embed_model (HuggingFaceEmbedding): embedding model for the prompts
+            threshold (float, optional): minimum cosine similarity for a hit.
+                Defaults to SEMANTIC_CACHE["threshold"].
+            size (int, optional): maximum prompts in the index, the least
+                recently used ones are evicted. Defaults to SEMANTIC_CACHE["size"].
+        """
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.size = size
+        self.vectors = None
+        self.prompts = []
+        self.instructions = []
+        self.terms = []
+        # slots of the removed prompts, refilled first by add()
+        self.free = []
+        self.last_used = np.zeros(size, dtype=np.int64)
+        self.clock = 0
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "entries": 0}
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.prompts) - len(self.free)
+
+    def embed(self, prompt: str) -> np.ndarray:
+        """Embed a prompt as a unit vector
+
+        Args:
+            prompt (str): user prompt
+
+        Returns:
+            np.ndarray: prompt embedding
+        """
+        embedding = np.asarray(
+            self.embed_model.get_query_embedding(normalize_prompt(prompt)),
+            dtype=np.float32,
+        )
+        return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+    def get(self, embedding: np.ndarray, terms: frozenset = None):
+        """Get the pandas instruction of the most similar past prompt
+
+        Args:
+            embedding (np.ndarray): prompt embedding from embed()
+            terms (frozenset, optional): columns and aggregations of the prompt
+                from prompt_terms(), the past prompt must have the same ones.
+                Defaults to None (not checked).
+
+        Returns:
+            str: pandas instruction, None if no past prompt is close enough
+        """
+        with self.lock:
+            instruction = None
+            if len(self.prompts) > 0:
+                similarity = self.vectors[: len(self.prompts)] @ embedding
+                for index in np.argsort(-similarity):
+                    if similarity[index] < self.threshold:
+                        break
+                    if self.instructions[index] is None or (
+                        terms is not None and self.terms[index] != terms
+                    ):
+                        continue
+                    self.clock += 1
+                    self.last_used[index] = self.clock
+                    instruction = self.instructions[index]
+                    break
+
+            self.stats["hits" if instruction is not None else "misses"] += 1
+            return instruction
+
+    def add(
+        self,
+        embedding: np.ndarray,
+        prompt: str,
+        pandas_instruction_str: str,
+        terms: frozenset = None,
+    ):
+        """Add a prompt and its pandas instruction to the index
+
+        Args:
+            embedding (np.ndarray): prompt embedding from embed()
+            prompt (str): user prompt
+            pandas_instruction_str (str): pandas instruction for the prompt
+            terms (frozenset, optional): columns and aggregations of the prompt
+                from prompt_terms(). Defaults to None.
+        """
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.size, len(embedding)), dtype=np.float32)
+
+            if len(self.free) > 0:
+                index = self.free.pop()
+            elif len(self.prompts) < self.size:
+                index = len(self.prompts)
+                self.prompts.append(None)
+                self.instructions.append(None)
+                self.terms.append(None)
+            else:
+                index = int(np.argmin(self.last_used))
+
+            self.prompts[index] = prompt
+            self.instructions[index] = pandas_instruction_str
+            self.terms[index] = terms
+            self.stats["entries"] = len(self.prompts) - len(self.free)
+            self.clock += 1
+            self.vectors[index] = embedding
+            self.last_used[index] = self.clock
+
+    def remove(self, pandas_instruction_str: str):
+        """Remove a pandas instruction from the index, e.g., it fails on the data
+
+        Args:
+            pandas_instruction_str (str): pandas instruction to be removed
+        """
+        with self.lock:
+            for index, instruction in enumerate(self.instructions):
+                if instruction == pandas_instruction_str:
+                    self.prompts[index] = None
+                    self.instructions[index] = None
+                    self.terms[index] = None
+                    self.vectors[index] = 0.0
+                    self.last_used[index] = 0
+                    self.free.append(index)
+            self.stats["entries"] = len(self.prompts) - len(self.free)
@@ -1,26 +1,238 @@
-from os.path import join
+from hashlib import sha256
+from json import dumps as json_dumps
+from os import listdir, makedirs, remove, stat
+from os.path import abspath, exists, join, split
+from warnings import catch_warnings, simplefilter
 
-from pandas import DataFrame, read_excel, read_parquet
+from pandas import DataFrame, ExcelFile, read_parquet, to_datetime, to_numeric
+from pandas.api.types import (
+    is_bool_dtype,
+    is_numeric_dtype,
+    is_object_dtype,
+    is_string_dtype,
+)
+from pandas.util import hash_pandas_object
 
-from process import DATA_PATH
+from process import DATA_CACHE, DATA_RELOAD, DATA_SCHEMA, DATASETS
 
+# changed with the data types of compact_data, so the older cache is not read
+COMPACT_VERSION = 2
 
-def read_data(
-        data_type: str = "leaft") -> DataFrame:
+
+def read_data(data_type: str = "leaft") -> DataFrame:
     """Read input data
 
     Args:
-        data_type (str, optional): data to be used. Defaults to "leaft".
+        data_type (str, optional): dataset to be used, see DATASETS. Defaults to "leaft".
 
     Returns:
         DataFrame: decoded data
     """
-    if data_type == "leaft":
-        return read_leaft_data(DATA_PATH["leaft"])
+    cache_dir = DATA_CACHE["dir"] if DATA_CACHE["enable"] else None
+
+    if data_type in DATASETS:
+        return read_leaft_data(
+            DATASETS[data_type]["path"],
+            DATASETS[data_type]["sheet"],
+            cache_dir=cache_dir,
+        )
 
     raise Exception(f"Data type {data_type} is not supported ...")
 
 
+def validate_data(
+    df: DataFrame, required_columns: list = DATA_RELOAD["required_columns"]
+):
+    """Check if the data can be queried, e.g., before it replaces the current data
+
+    Args:
+        df (DataFrame): input data
+        required_columns (list, optional): columns the data must have.
+            Defaults to DATA_RELOAD["required_columns"].
+
+    Raises:
+        Exception: Data is empty or columns are missing
+    """
+    if len(df) == 0:
+        raise Exception("Data has no rows left after cleaning ...")
+
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if len(missing_columns) > 0:
+        raise Exception(f"Columns {missing_columns} are missing from the data ...")
+
+
+def data_fingerprint(df: DataFrame) -> str:
+    """Get the fingerprint of the data, which changes whenever
+    the values, columns or data types change
+
+    Args:
+        df (DataFrame): input data
+
+    Returns:
+        str: data fingerprint
+    """
+    data_hash = sha256(hash_pandas_object(df, index=True).values.tobytes())
+    data_hash.update(json_dumps([str(col) for col in df.columns]).encode())
+    data_hash.update(json_dumps([str(dtype) for dtype in df.dtypes]).encode())
+    return data_hash.hexdigest()[:16]
+
+
+def _data_cache_path(
+    cache_dir: str,
+    data_path: str,
+    data_type: str,
+    excludes: list,
+    remove_nan: bool,
+    compact: bool,
+    use_hash: bool = DATA_CACHE["hash"],
+) -> str:
+    """Get the cache file path for a workbook sheet
+
+    The file name is made of a prefix identifying the workbook/sheet and a
+    suffix identifying the workbook version and the cleaning options, so that
+    an edited workbook never hits a stale cache.
+
+    Args:
+        cache_dir (str): directory to keep the cached files
+        data_path (str): workbook path
+        data_type (str): sheet name
+        excludes (list): columns to be dropped
+        remove_nan (bool): if rows with NaN are dropped
+        compact (bool): if the data types are compacted
+        use_hash (bool, optional): if the workbook content (instead of its
+            mtime and size) is used as the version. Defaults to DATA_CACHE["hash"].
+
+    Returns:
+        str: cache file path
+    """
+    data_path = abspath(data_path)
+
+    if use_hash:
+        with open(data_path, "rb") as fid:
+            data_version = sha256(fid.read()).hexdigest()
+    else:
+        data_stat = stat(data_path)
+        data_version = f"{data_stat.st_mtime_ns}-{data_stat.st_size}"
+
+    prefix = sha256(json_dumps([data_path, data_type]).encode()).hexdigest()[:16]
+    suffix = sha256(
+        json_dumps(
+            [data_version, excludes, remove_nan, compact, COMPACT_VERSION]
+        ).encode()
+    ).hexdigest()[:16]
+
+    return join(cache_dir, f"{prefix}_{suffix}.parquet")
+
+
+def _write_data_cache(df: DataFrame, cache_path: str):
+    """Write the cleaned data to the cache, and remove
+    the outdated caches of the same workbook sheet
+
+    Args:
+        df (DataFrame): cleaned data
+        cache_path (str): cache file path
+    """
+    cache_dir, cache_name = split(cache_path)
+    makedirs(cache_dir, exist_ok=True)
+
+    try:
+        df.to_parquet(cache_path, index=False)
+    except Exception as e:
+        print(f"Not able to cache data to {cache_path}: {e}")
+        return
+
+    prefix = cache_name.split("_")[0]
+    for proc_file in listdir(cache_dir):
+        if proc_file.startswith(f"{prefix}_") and proc_file != cache_name:
+            remove(join(cache_dir, proc_file))
+
+
+def _compact_series(series, category_ratio: float):
+    """Convert a column to a compact data type holding its values, without
+    narrowing the integers
+
+    Args:
+        series (Series): column to be converted
+        category_ratio (float): the maximum ratio of unique values
+            to rows for a text column to become categorical
+
+    Returns:
+        Series: converted column
+    """
+    if is_bool_dtype(series):
+        return series
+
+    is_text = is_object_dtype(series) or is_string_dtype(series)
+
+    if is_text:
+        numeric = to_numeric(series, errors="coerce")
+        if numeric.notna().sum() == series.notna().sum():
+            series = numeric
+
+    if is_numeric_dtype(series):
+        # the integers are kept in int64, as the code on a smaller type
+        # overflows silently, e.g., int8 * 100
+        if series.notna().all() and (series % 1 == 0).all():
+            return series.astype("int64")
+
+        # float32 is only used when no value changes
+        series = series.astype("float64")
+        series_float32 = series.astype("float32")
+        if (series_float32.astype("float64") == series)[series.notna()].all():
+            return series_float32
+        return series
+
+    if not is_text:
+        return series
+
+    with catch_warnings():
+        simplefilter("ignore")
+        dates = to_datetime(series, errors="coerce")
+    if dates.notna().sum() == series.notna().sum():
+        return dates
+
+    if series.nunique() <= category_ratio * len(series):
+        return series.astype("category")
+
+    return series
+
+
+def compact_data(
+    df: DataFrame,
+    category_ratio: float = DATA_SCHEMA["category_ratio"],
+    verbose: bool = True,
+) -> DataFrame:
+    """Infer the data types of the data, e.g., the columns are all object
+    after promoting the first row to the header:
+        - integer columns are converted to int64, and float columns to float32
+          if no value changes
+        - date columns are parsed as datetime
+        - low-cardinality text columns are converted to categorical
+
+    Args:
+        df (DataFrame): data to be converted
+        category_ratio (float, optional): the maximum ratio of unique values to rows
+            for a text column to become categorical. Defaults to DATA_SCHEMA["category_ratio"].
+        verbose (bool, optional): if report the memory saved. Defaults to True.
+
+    Returns:
+        DataFrame: data with compact data types
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+
+    df = DataFrame(
+        {col: _compact_series(df[col], category_ratio) for col in df.columns},
+        index=df.index,
+    )
+
+    if verbose:
+        memory_after = df.memory_usage(deep=True).sum()
+        print(
+            f"Data memory: {memory_before / 1e6:.3f} MB -> {memory_after / 1e6:.3f} MB "
+            f"({memory_before - memory_after} bytes saved)"
+        )
+
+    return df
 
 
 def read_leaft_data(
@@ -35,6 +247,8 @@ def read_leaft_data(
         "Membrane",
     ],
     remove_nan: bool = True,
+    compact: bool = True,
+    cache_dir: str = None,
 ) -> DataFrame:
     """Read data from Leaft
 
@@ -43,21 +257,32 @@ def read_leaft_data(
         data_type (str): e.g., Full. Crop -> Juice -> Final
         excludes (list): e.g.,
         ["Water flux", "Notes", "Flux during concentration", "Flux during diafiltration", "R.FW.Sep", "Membrane]
+        remove_nan (bool): if rows with NaN are dropped
+        compact (bool): if the data types are inferred and compacted (see compact_data)
+        cache_dir (str, optional): if set, the cleaned data is cached as parquet
+            in this directory and memory-mapped on later reads. Defaults to None.
 
 
     Returns:
         DataFrame: Data in pandas format
     """
+    if cache_dir is not None:
+        cache_path = _data_cache_path(
+            cache_dir, data_path, data_type, excludes, remove_nan, compact
+        )
+        if exists(cache_path):
+            return read_parquet(cache_path, memory_map=True)
 
-    df = read_excel(data_path, sheet_name=None, skiprows=0)
-    df = {key.rstrip(): value for key, value in df.items()}
+    # only the requested sheet is parsed
+    with ExcelFile(data_path) as excel_file:
+        all_df_keys = {key.rstrip(): key for key in excel_file.sheet_names}
 
-    all_df_keys = list(df.keys())
+        if data_type not in all_df_keys:
+            raise Exception(
+                f"Not able to recognize {data_type} ... from {list(all_df_keys)}"
+            )
 
-    if data_type not in all_df_keys:
-        raise Exception(f"Not able to recognize {data_type} ... from {all_df_keys}")
-
-    df = df[data_type]
+        df = excel_file.parse(all_df_keys[data_type], skiprows=0)
 
     if "Trial" not in df.columns:
         df.columns = df.iloc[0]
@@ -75,4 +300,10 @@ def read_leaft_data(
 
     df = df.reset_index(drop=True)
 
+    if compact:
+        df = compact_data(df)
+
+    if cache_dir is not None:
+        _write_data_cache(df, cache_path)
+
     return df
@@ -0,0 +1,244 @@
+from multiprocessing import get_context
+from os import close, remove
+from os.path import exists
+from queue import Empty, Queue
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+from pandas import DataFrame, RangeIndex
+from pandas.api.types import is_object_dtype
+from pyarrow import ArrowException
+from pyarrow import array as arrow_array
+
+from process import CODE_EXECUTOR
+from process.workers import executor_worker_main
+
+
+def _get_private_rss(pid: int) -> int:
+    """Get the resident memory of a process not shared with the others, e.g.,
+    without the pages of the memory-mapped data
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        int: resident memory in bytes, 0 if unknown
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as fid:
+            resident, shared = fid.read().split()[1:3]
+            return (int(resident) - int(shared)) * 4096
+    except (OSError, ValueError):
+        return 0
+
+
+def _is_arrow_compatible(series) -> bool:
+    """Check if Arrow can store a column, e.g., not a column mixing text and numbers"""
+    if not is_object_dtype(series) and series.dtype != "category":
+        return True
+    try:
+        arrow_array(series, from_pandas=True)
+    except ArrowException:
+        return False
+    return True
+
+
+class IsolatedExecutor:
+    """Run the generated pandas/plotting code in pre-started worker processes.
+
+    The workers read the data from a memory-mapped Arrow file, and a worker
+    exceeding the time, CPU time or memory limit is killed and replaced, so
+    one bad query does not affect the dashboard process.
+
+    The numeric columns without missing values are read-only views of the
+    memory map shared by the workers, so changing them in place may fail. The
+    other columns (e.g., strings) are copied into each worker and count
+    towards its memory limit, the columns Arrow cannot store (e.g., mixing text
+    and numbers) are sent to each worker as they are.
+    """
+
+    def __init__(
+        self,
+        df: DataFrame,
+        workers: int = CODE_EXECUTOR["workers"],
+        timeout: float = CODE_EXECUTOR["timeout"],
+        cpu_time: int = CODE_EXECUTOR["cpu_time"],
+        memory: int = CODE_EXECUTOR["memory"],
+        data_dir: str = CODE_EXECUTOR["dir"],
+    ):
+        """Initialize the executor and start the workers
+
+        Args:
+            df (DataFrame): data used by the code
+            workers (int, optional): number of worker processes. Defaults to CODE_EXECUTOR["workers"].
+            timeout (float, optional): wall time limit in seconds. Defaults to CODE_EXECUTOR["timeout"].
+            cpu_time (int, optional): CPU time limit in seconds. Defaults to CODE_EXECUTOR["cpu_time"].
+            memory (int, optional): resident memory limit in bytes of each worker,
+                the shared data is not counted. Defaults to CODE_EXECUTOR["memory"].
+            data_dir (str, optional): directory of the shared Arrow file, e.g., /dev/shm.
+                Defaults to CODE_EXECUTOR["dir"].
+        """
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.context = get_context("spawn")
+
+        fid, self.data_path = mkstemp(
+            suffix=".arrow", dir=data_dir if exists(data_dir) else None
+        )
+        close(fid)
+        # the Arrow columns are named by position, the workers set the labels
+        # back, so the labels are not limited to the unique strings
+        self.columns = df.columns
+        self.index = None if df.index.equals(RangeIndex(len(df))) else df.index
+        df = df.set_axis([str(i) for i in range(df.shape[1])], axis=1).reset_index(
+            drop=True
+        )
+        self.objects = {
+            i: df.iloc[:, i].array
+            for i in range(df.shape[1])
+            if not _is_arrow_compatible(df.iloc[:, i])
+        }
+        try:
+            df.drop(columns=[str(i) for i in self.objects]).to_feather(
+                self.data_path, compression="uncompressed"
+            )
+        except Exception:
+            remove(self.data_path)
+            raise
+
+        self.closed = False
+        self.lock = Lock()
+        self.workers = Queue()
+        for _ in range(workers):
+            self.workers.put(self._start_worker())
+
+    def _start_worker(self) -> tuple:
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=executor_worker_main,
+            args=(
+                worker_conn,
+                self.data_path,
+                self.cpu_time,
+                self.columns,
+                self.index,
+                self.objects,
+            ),
+            daemon=True,
+        )
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def _submit(self, task_type: str, pandas_instruction_str: str):
+        """Run a code in a worker, the worker is replaced if it fails
+
+        Args:
+            task_type (str): plot or pandas
+            pandas_instruction_str (str): code to be run
+
+        Raises:
+            Exception: the code fails or exceeds the limits, or the executor is shut down
+
+        Returns:
+            the result of the code
+        """
+        worker = None
+        while worker is None:
+            if self.closed:
+                raise Exception(
+                    "Code executor is shut down, e.g., the data is released"
+                )
+            try:
+                worker = self.workers.get(timeout=0.1)
+            except Empty:
+                pass
+
+        process, conn = worker
+        error = None
+        try:
+            conn.send((task_type, pandas_instruction_str))
+            deadline = time() + self.timeout
+            while not conn.poll(0.05):
+                if not process.is_alive():
+                    error = "the worker is stopped, e.g., CPU time limit exceeded"
+                elif time() > deadline:
+                    error = f"time limit ({self.timeout} seconds) exceeded"
+                elif _get_private_rss(process.pid) > self.memory:
+                    error = f"memory limit ({self.memory} bytes) exceeded"
+                if error is not None:
+                    break
+
+            if error is None:
+                status, result = conn.recv()
+        except (EOFError, OSError):
+            error = "the worker is stopped, e.g., CPU time limit exceeded"
+        finally:
+            if error is not None:
+                process.kill()
+                process.join()
+                conn.close()
+                if not self.closed:
+                    process, conn = self._start_worker()
+            with self.lock:
+                closed = self.closed
+                if not closed:
+                    self.workers.put((process, conn))
+            if closed:
+                # the executor is shut down while the code is running
+                self._stop_worker(process, conn)
+
+        if error is not None:
+            raise Exception(f"Code is stopped, {error}: {pandas_instruction_str}")
+
+        if status == "error":
+            raise Exception(result)
+
+        return result
+
+    def run(self, pandas_instruction_str: str) -> str:
+        """Run a pandas instruction, see process.utils.run_pandas_instruction
+
+        Args:
+            pandas_instruction_str (str): Pandas instruction
+
+        Returns:
+            str: the output of the last line of the instruction
+        """
+        return self._submit("pandas", pandas_instruction_str)
+
+    def render(self, pandas_instruction_str: str) -> bytes:
+        """Render a plotting instruction, see process.utils.render_img
+
+        Args:
+            pandas_instruction_str (str): Pandas instruction
+
+        Returns:
+            bytes: image in PNG
+        """
+        return self._submit("plot", pandas_instruction_str)
+
+    def _stop_worker(self, process, conn):
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(timeout=1)
+        if process.is_alive():
+            process.kill()
+
+    def shutdown(self):
+        """Stop the workers and remove the shared data, the code still running
+        finishes and the new code is refused
+        """
+        with self.lock:
+            self.closed = True
+            workers = []
+            while not self.workers.empty():
+                workers.append(self.workers.get())
+        for process, conn in workers:
+            self._stop_worker(process, conn)
+        if exists(self.data_path):
+            remove(self.data_path)
@@ -0,0 +1,81 @@
+from collections import OrderedDict, deque
+from threading import Lock
+
+from process import HISTORY
+
+
+class ConversationHistory:
+    """Conversation of each session kept on the server, so the page only
+    receives the new questions and answers
+    """
+
+    def __init__(
+        self,
+        size: int = HISTORY["size"],
+        sessions: int = HISTORY["sessions"],
+    ):
+        """Initialize the conversation history
+
+        Args:
+            size (int, optional): maximum entries of a session, the oldest
+                entries are removed first. Defaults to HISTORY["size"].
+            sessions (int, optional): maximum sessions, the least recently
+                used sessions are removed first. Defaults to HISTORY["sessions"].
+        """
+        self.size = size
+        self.sessions = sessions
+        self.history = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, session_id: str) -> list:
+        """Get the conversation of a session
+
+        Args:
+            session_id (str): session id
+
+        Returns:
+            list: questions and answers
+        """
+        with self.lock:
+            if session_id not in self.history:
+                return []
+            self.history.move_to_end(session_id)
+            return list(self.history[session_id])
+
+    def append(self, session_id: str, entry: dict) -> bool:
+        """Add a question and answer to the conversation of a session
+
+        Args:
+            session_id (str): session id
+            entry (dict): question and answer
+
+        Returns:
+            bool: if the oldest entry of the session is removed
+        """
+        with self.lock:
+            if session_id not in self.history:
+                self.history[session_id] = deque(maxlen=self.size)
+            self.history.move_to_end(session_id)
+
+            entries = self.history[session_id]
+            evicted = len(entries) == self.size
+            entries.append(entry)
+
+            while len(self.history) > self.sessions:
+                self.history.popitem(last=False)
+
+            return evicted
+
+    def image_sources(self) -> set:
+        """Get the image URLs of the answers of all the sessions
+
+        Returns:
+            set: image URLs
+        """
+        with self.lock:
+            return {
+                entry["answer"]["image_src"]
+                for entries in self.history.values()
+                for entry in entries
+                if entry["answer"].get("image_src") is not None
+            }
@@ -0,0 +1,244 @@
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread, local
+from time import time
+from uuid import uuid4
+
+from process import JOB_QUEUE
+from process.metrics import metrics
+
+current_job = local()
+
+
+class JobCancelled(Exception):
+    """The job has been cancelled, e.g., its session has submitted a newer prompt"""
+
+
+def is_cancelled() -> bool:
+    """Check if the job run by this thread has been cancelled
+
+    Returns:
+        bool: if it has been cancelled, False outside of a job
+    """
+    job = getattr(current_job, "job", None)
+    return job is not None and job["cancelled"]
+
+
+def check_cancelled():
+    """Stop the job run by this thread if it has been cancelled
+
+    Raises:
+        JobCancelled: The job has been cancelled
+    """
+    if is_cancelled():
+        raise JobCancelled("The job has been cancelled")
+
+
+class JobQueue:
+    """Local job queue running the slow work (e.g., LLM generation) on a
+    worker pool, so the web workers return a job id immediately and poll it.
+
+    The sessions take turns (round robin), so a session submitting many jobs
+    does not hold back the others. A new job is rejected when too many jobs
+    are waiting, and a new job of a session cancels its older ones: the
+    waiting ones are dropped and the running one stops at its next check
+    (see check_cancelled).
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_QUEUE["workers"],
+        max_jobs: int = JOB_QUEUE["max_jobs"],
+        max_depth: int = JOB_QUEUE["max_depth"],
+    ):
+        """Initialize the job queue
+
+        Args:
+            workers (int, optional): number of worker threads. Defaults to JOB_QUEUE["workers"].
+            max_jobs (int, optional): maximum jobs to be kept, the oldest
+                finished jobs are removed first. Defaults to JOB_QUEUE["max_jobs"].
+            max_depth (int, optional): maximum jobs waiting to be run, the new
+                jobs are rejected beyond it. Defaults to JOB_QUEUE["max_depth"].
+        """
+        self.max_jobs = max_jobs
+        self.max_depth = max_depth
+        self.jobs = OrderedDict()
+        # waiting job ids of each session, in the order the sessions take turns
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.rejected = 0
+        self.cancelled = 0
+
+        for _ in range(workers):
+            Thread(target=self._work, daemon=True).start()
+
+    def submit(
+        self,
+        func,
+        *args,
+        session_id: str = None,
+        report_progress: bool = False,
+        on_finish=None,
+        **kwargs,
+    ) -> str:
+        """Submit a job
+
+        Args:
+            func (callable): function to be run
+            session_id (str, optional): session of the job, its older jobs are
+                cancelled. Defaults to None (a session of its own).
+            report_progress (bool, optional): if func reports the partial result with the
+                on_progress keyword argument, which is kept as job["progress"]. Defaults to False.
+            on_finish (callable, optional): called once the job is done, failed, cancelled,
+                removed or rejected, e.g., to release what it holds. Defaults to None.
+
+        Returns:
+            str: job id, None if the queue is full
+        """
+        job_id = uuid4().hex
+        job = {
+            "status": "queued",
+            "result": None,
+            "progress": None,
+            "error": None,
+            "session_id": session_id or job_id,
+            "cancelled": False,
+            "submitted_at": time(),
+            "finished_at": None,
+            "on_finish": on_finish,
+        }
+
+        if report_progress:
+            kwargs["on_progress"] = lambda progress: job.update({"progress": progress})
+        job["task"] = (func, args, kwargs)
+
+        with self.lock:
+            # the waiting jobs of the session are replaced by the new one, and
+            # only cancelled once it is accepted
+            waiting = sum(
+                len(job_ids)
+                for session_id, job_ids in self.sessions.items()
+                if session_id != job["session_id"]
+            )
+            if waiting >= self.max_depth:
+                self.rejected += 1
+                self._finish(job)
+                return None
+
+            self._cancel_session(job["session_id"])
+            self.jobs[job_id] = job
+            self._evict()
+            self.sessions.setdefault(job["session_id"], deque()).append(job_id)
+            self.condition.notify()
+
+        return job_id
+
+    def _cancel_session(self, session_id: str):
+        for job_id in self.sessions.pop(session_id, []):
+            self.jobs[job_id].update({"status": "cancelled", "finished_at": time()})
+            self._finish(self.jobs[job_id])
+            self.cancelled += 1
+
+        for job in self.jobs.values():
+            if (
+                job["session_id"] == session_id
+                and job["status"] == "running"
+                and not job["cancelled"]
+            ):
+                job["cancelled"] = True
+                self.cancelled += 1
+
+    def _next_job(self) -> dict:
+        with self.lock:
+            while len(self.sessions) == 0:
+                self.condition.wait()
+
+            session_id, job_ids = next(iter(self.sessions.items()))
+            job = self.jobs[job_ids.popleft()]
+            if len(job_ids) > 0:
+                self.sessions.move_to_end(session_id)
+            else:
+                self.sessions.pop(session_id)
+
+            job["status"] = "running"
+            return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            metrics.record("queue_wait", time() - job["submitted_at"])
+            self._run(job)
+
+    def _run(self, job: dict):
+        func, args, kwargs = job.pop("task")
+        current_job.job = job
+        try:
+            job["result"] = func(*args, **kwargs)
+            job["status"] = "done"
+        except JobCancelled:
+            job["status"] = "cancelled"
+        except Exception as e:
+            job["error"] = str(e)
+            job["status"] = "failed"
+            print(f"Job failed: {e}")
+        finally:
+            current_job.job = None
+            self._finish(job)
+        job["finished_at"] = time()
+
+    def _finish(self, job: dict):
+        on_finish = job.pop("on_finish", None)
+        if on_finish is not None:
+            try:
+                on_finish()
+            except Exception as e:
+                print(f"Job finishing failed: {e}")
+
+    def _evict(self):
+        finished_jobs = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job["status"] in ["done", "failed", "cancelled"]
+        ]
+        while len(self.jobs) > self.max_jobs and finished_jobs:
+            self.jobs.pop(finished_jobs.pop(0))
+
+    def get(self, job_id: str):
+        """Get a job
+
+        Args:
+            job_id (str): job id
+
+        Returns:
+            dict: job with status (queued, running, done, failed or cancelled), result,
+                progress and error, None if the job is not found
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def pop(self, job_id: str):
+        """Remove a job, e.g., after its result has been delivered
+
+        Args:
+            job_id (str): job id
+        """
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is not None and job["status"] == "queued":
+                job_ids = self.sessions[job["session_id"]]
+                job_ids.remove(job_id)
+                if len(job_ids) == 0:
+                    self.sessions.pop(job["session_id"])
+                self._finish(job)
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queued": sum(len(job_ids) for job_ids in self.sessions.values()),
+                "running": sum(
+                    job["status"] == "running" for job in self.jobs.values()
+                ),
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+            }
@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+from json import dumps as json_dumps
+from threading import Lock, local
+from time import time
+
+from process import METRICS
+
+
+class Metrics:
+    """Latency histograms and counters of the pipeline stages,
+    exported in the Prometheus text format
+
+    The spans of a request (see trace()) can also be written to a trace log.
+    """
+
+    def __init__(
+        self,
+        prefix: str = METRICS["prefix"],
+        buckets: list = METRICS["buckets"],
+        metric_buckets: dict = METRICS["metric_buckets"],
+        trace_log: str = METRICS["trace_log"],
+    ):
+        """Initialize the metrics
+
+        Args:
+            prefix (str, optional): prefix of the metric names. Defaults to METRICS["prefix"].
+            buckets (list, optional): histogram buckets in seconds. Defaults to METRICS["buckets"].
+            metric_buckets (dict, optional): buckets of the other histograms, by name.
+                Defaults to METRICS["metric_buckets"].
+            trace_log (str, optional): file for the request traces (JSON lines),
+                None to disable it. Defaults to METRICS["trace_log"].
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self.metric_buckets = metric_buckets
+        self.trace_log = trace_log
+        self.histograms = {}
+        self.counters = {}
+        self.lock = Lock()
+        self.local = local()
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a value to a histogram
+
+        Args:
+            name (str): histogram name
+            value (float): value to be added
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                buckets = self.metric_buckets.get(name, self.buckets)
+                self.histograms[key] = {
+                    "le": buckets,
+                    "buckets": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            histogram = self.histograms[key]
+            for i, bucket in enumerate(histogram["le"]):
+                if value <= bucket:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increase a counter
+
+        Args:
+            name (str): counter name
+            value (float, optional): increment. Defaults to 1.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, stage: str, duration: float, **attrs):
+        """Record the latency of a stage, and add it to the current trace
+
+        Args:
+            stage (str): stage name, e.g., code_generation
+            duration (float): latency in seconds
+        """
+        self.observe("stage_seconds", duration, stage=stage)
+        spans = getattr(self.local, "spans", None)
+        if spans is not None:
+            spans.append({"stage": stage, "duration": duration, **attrs})
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """Time a stage, e.g.,
+
+            with metrics.span("summarization"):
+                ...
+
+        Args:
+            stage (str): stage name
+        """
+        start_t = time()
+        try:
+            yield
+        finally:
+            self.record(stage, time() - start_t, **attrs)
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Collect the spans of a request (in this thread) and write them to the trace log
+
+        Args:
+            name (str): request name, e.g., insight
+        """
+        if self.trace_log is None or getattr(self.local, "spans", None) is not None:
+            yield
+            return
+
+        self.local.spans = []
+        start_t = time()
+        try:
+            yield
+        finally:
+            trace = {
+                "name": name,
+                "start": start_t,
+                "duration": time() - start_t,
+                **attrs,
+                "spans": self.local.spans,
+            }
+            self.local.spans = None
+            with self.lock:
+                with open(self.trace_log, "a") as fid:
+                    fid.write(json_dumps(trace, default=str) + "\n")
+
+    def render(self, gauges: dict = {}) -> str:
+        """Export the metrics in the Prometheus text format
+
+        Args:
+            gauges (dict, optional): extra values, {(name, labels): value}. Defaults to {}.
+
+        Returns:
+            str: metrics
+        """
+
+        def _labels(labels, **extra_labels) -> str:
+            labels = list(labels) + list(extra_labels.items())
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = f"{self.prefix}_{name}"
+                if f"# TYPE {name} histogram" not in lines:
+                    lines.append(f"# TYPE {name} histogram")
+                for bucket, count in zip(histogram["le"], histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_labels(labels, le=bucket)} {count}")
+                lines.append(
+                    f"{name}_bucket{_labels(labels, le='+Inf')} {histogram['count']}"
+                )
+                lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+
+            for (name, labels), value in sorted(self.counters.items()):
+                name = f"{self.prefix}_{name}_total"
+                if f"# TYPE {name} counter" not in lines:
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), value in sorted(gauges.items()):
+            name = f"{self.prefix}_{name}"
+            if f"# TYPE {name} gauge" not in lines:
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -1,40 +1,282 @@
 from base64 import b64encode
+from functools import lru_cache
 from io import BytesIO
-from typing import List, Optional, Sequence
-
-from llama_cpp import Llama
+from re import sub as re_sub
+from threading import local
+from time import time
+from typing import Any, List, Optional, Sequence
+
+from llama_cpp import (
+    Llama,
+    LlamaDiskCache,
+    LlamaGrammar,
+    LlamaRAMCache,
+    StoppingCriteriaList,
+)
 from llama_index.core import ServiceContext, set_global_service_context
 from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.base.response.schema import Response
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import (
+    LLMCompletionEndEvent,
+    LLMCompletionStartEvent,
+)
+from llama_index.core.output_parsers.utils import parse_code_markdown
+from llama_index.core.prompts import PromptTemplate, PromptType
+from llama_index.core.schema import QueryBundle
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.experimental.query_engine import PandasQueryEngine
+from llama_index.experimental.query_engine.pandas.output_parser import (
+    PandasInstructionParser,
+)
 from llama_index.llms.llama_cpp import LlamaCPP
 from matplotlib.pyplot import close as plt_close
 from pandas import DataFrame
 
 from process import LOCAL_MODEL_SETUPS
+from process.jobs import check_cancelled, is_cancelled
+from process.metrics import metrics
+from process.runtime import get_runtime_profile
+from process.schema import SchemaContext, estimate_tokens
 
 BOS, EOS = "<s>", "</s>"
 B_INST, E_INST = "[INST]", "[/INST]"
 B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
+# in place of the question in the prompts primed in the prompt cache
+QUERY_MARKER = "<<QUERY>>"
 DEFAULT_SYSTEM_PROMPT = """\
 You are a helpful, respectful and honest assistant. \
 Always answer as helpfully as possible and follow ALL given instructions. \
 Do not speculate or make up information. \
 Do not reference any given instructions or context. \
 """
+# the answer of PandasQueryEngine when the generated instruction fails
+INSTRUCTION_ERROR = "There was an error running the output as Python code."
+# the default PandasQueryEngine prompt, with the schema summary instead of df.head()
+SCHEMA_PANDAS_PROMPT = PromptTemplate(
+    "You are working with a pandas dataframe in Python.\n"
+    "The name of the dataframe is `df`.\n"
+    "This is the schema of `df` (column, data type, unit, range and example values):\n"
+    "{df_str}\n\n"
+    "Follow these instructions:\n"
+    "{instruction_str}\n"
+    "Query: {query_str}\n\n"
+    "Expression:",
+    prompt_type=PromptType.PANDAS,
+)
+
+
+def clean_instruction(output: str) -> str:
+    """Get the pandas instruction of a code model output, i.e., the code of its
+    last markdown block (or the whole output) without the surrounding spaces
+
+    Args:
+        output (str): code model output
+
+    Returns:
+        str: pandas instruction
+    """
+    fenced = output.strip().startswith("```") or output.count("```") >= 2
+    output = parse_code_markdown(output, only_last=True)
+    if not isinstance(output, str):
+        output = output[0]
+    if fenced:
+        # the language of the block, e.g., ```python
+        output = re_sub(r"^[\w+-]*\n", "", output)
+    return output.strip()
+
+
+class IsolatedInstructionParser(PandasInstructionParser):
+    """Pandas instruction parser running the instructions
+    in the worker processes of an IsolatedExecutor
+    """
+
+    def __init__(self, df: DataFrame, executor, output_kwargs: dict = None):
+        super().__init__(df, output_kwargs)
+        self.executor = executor
+
+    def parse(self, output: str) -> Any:
+        output = clean_instruction(output)
+
+        try:
+            with metrics.span("pandas_execution"):
+                return self.executor.run(output)
+        except Exception as e:
+            # the same as the default PandasQueryEngine output processor
+            return f"{INSTRUCTION_ERROR} Error message: {e}"
+
+
+class LLMMetricsHandler(BaseEventHandler):
+    """Record the latency and tokens of the LlamaIndex LLM (the code model) completions"""
+
+    start_times: dict = {}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LLMMetricsHandler"
+
+    def handle(self, event, **kwargs):
+        if isinstance(event, LLMCompletionStartEvent):
+            self.start_times[event.span_id] = event.timestamp
+        elif isinstance(event, LLMCompletionEndEvent):
+            start_time = self.start_times.pop(event.span_id, None)
+            if start_time is None:
+                return
+            duration = (event.timestamp - start_time).total_seconds()
+
+            usage = {}
+            if isinstance(event.response.raw, dict):
+                usage = event.response.raw.get("usage", {})
+            completion_tokens = usage.get("completion_tokens", 0)
+
+            metrics.record(
+                "code_generation",
+                duration,
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=completion_tokens,
+            )
+            metrics.inc(
+                "llm_tokens",
+                usage.get("prompt_tokens", 0),
+                model="code_model",
+                kind="prompt",
+            )
+            metrics.inc(
+                "llm_tokens", completion_tokens, model="code_model", kind="completion"
+            )
+            if duration > 0 and completion_tokens > 0:
+                metrics.observe(
+                    "llm_tokens_per_second",
+                    completion_tokens / duration,
+                    model="code_model",
+                )
+
+
+class RoutedQueryEngine:
+    """Query engine trying a small code model first, the question is sent to
+    the (large) code model only when the instruction from the small one does
+    not parse or run on the data
+
+    The decisions are counted by the code_routing metric, and the latency of
+    each tier is recorded as the query_engine_small/query_engine_large stages.
+    """
+
+    def __init__(
+        self, small_query_engine: PandasQueryEngine, query_engine: PandasQueryEngine
+    ):
+        """Initialize the routed query engine
+
+        Args:
+            small_query_engine (PandasQueryEngine): query engine of the small code model
+            query_engine (PandasQueryEngine): query engine of the code model
+        """
+        self.small_query_engine = small_query_engine
+        self.query_engine = query_engine
+
+    def query(self, prompt: str):
+        """Answer a prompt, see PandasQueryEngine.query
+
+        Args:
+            prompt (str): user prompt
+
+        Returns:
+            Response: answer with the pandas instruction in the metadata
+        """
+        start_t = time()
+        response = self.small_query_engine.query(prompt)
+        escalated = str(response.response).startswith(INSTRUCTION_ERROR)
+        metrics.record("query_engine_small", time() - start_t, escalated=escalated)
+
+        if not escalated:
+            metrics.inc("code_routing", decision="small")
+            return response
+
+        check_cancelled()
+        print(
+            "Instruction of the small code model failed, "
+            f"ask the code model: {response.metadata['pandas_instruction_str']}"
+        )
+        metrics.inc("code_routing", decision="escalated")
+        start_t = time()
+        response = self.query_engine.query(prompt)
+        metrics.record("query_engine_large", time() - start_t)
+        return response
+
 
+def register_llm_metrics():
+    """Record the metrics of the LlamaIndex LLM completions (once)"""
+    dispatcher = get_dispatcher()
+    if not any(
+        isinstance(handler, LLMMetricsHandler) for handler in dispatcher.event_handlers
+    ):
+        dispatcher.add_event_handler(LLMMetricsHandler())
 
-def create_dataframe_engine(df: DataFrame, verbose: bool = True) -> PandasQueryEngine:
+
+class SchemaQueryEngine(PandasQueryEngine):
+    """PandasQueryEngine with the schema summary of the data (see SchemaContext)
+    as the context instead of df.head()
+    """
+
+    def __init__(self, df: DataFrame, schema_context: SchemaContext, **kwargs: Any):
+        super().__init__(df=df, pandas_prompt=SCHEMA_PANDAS_PROMPT, **kwargs)
+        self._schema_context = schema_context
+        # the engine is shared by the job workers, so the question is per thread
+        self._local = local()
+
+    def _get_table_context(self) -> str:
+        query_str = getattr(self._local, "query_str", None)
+        context = self._schema_context.build(query_str)
+        if query_str is not None:
+            metrics.inc("prompt_context_tokens", estimate_tokens(context))
+        return context
+
+    def _query(self, query_bundle: QueryBundle) -> Response:
+        self._local.query_str = query_bundle.query_str
+        try:
+            return super()._query(query_bundle)
+        finally:
+            self._local.query_str = None
+
+
+def create_dataframe_engine(
+    df: DataFrame,
+    verbose: bool = True,
+    executor=None,
+    llm=None,
+    schema_context: SchemaContext = None,
+) -> PandasQueryEngine:
     """Creates a PandasQueryEngine for querying the given DataFrame.
 
     Args:
         df (DataFrame): The DataFrame to be queried.
         verbose (bool, optional): If True, enables verbose output. Defaults to True.
+        executor (IsolatedExecutor, optional): If set, the generated instructions are
+            run in its worker processes. Defaults to None.
+        llm (LLM, optional): code model, None to use the one of the global
+            service context (see load_service). Defaults to None.
+        schema_context (SchemaContext, optional): If set, its schema summary is the
+            context of the code model instead of df.head(). Defaults to None.
 
     Returns:
         PandasQueryEngine: An engine for querying the DataFrame.
     """
-    return PandasQueryEngine(df=df, verbose=verbose)
+    instruction_parser = None
+    if executor is not None:
+        instruction_parser = IsolatedInstructionParser(df, executor)
+
+    if schema_context is not None:
+        return SchemaQueryEngine(
+            df,
+            schema_context,
+            verbose=verbose,
+            instruction_parser=instruction_parser,
+            llm=llm,
+        )
+
+    return PandasQueryEngine(
+        df=df, verbose=verbose, instruction_parser=instruction_parser, llm=llm
+    )
 
 
 def load_service(llm_model, embed_model, chunk_size: int = 1024):
@@ -70,37 +312,160 @@ def load_embedding_model_local(
 
 
 def load_llm_model_local(
-    llm_model_name: str = LOCAL_MODEL_SETUPS["llm"]["path"], verbose: bool = False
+    llm_model_name: str = LOCAL_MODEL_SETUPS["llm"]["path"],
+    verbose: bool = False,
+    runtime_profile: dict = None,
 ):
     """Load LLM model
 
     Args:
         llm_model_name (str, optional): model path. Defaults to LOCAL_MODEL_SETUPS["llm"]["path"].
         verbose (bool, optional): if switch on debug. Defaults to False.
+        runtime_profile (dict, optional): llama.cpp settings, None to use the
+            configured one (see get_runtime_profile). Defaults to None.
 
     Returns:
         _type_: _description_
     """
-    return Llama(
+    if runtime_profile is None:
+        runtime_profile = get_runtime_profile("llm")
+
+    llm_model = Llama(
         model_path=llm_model_name,
         verbose=verbose,
+        **runtime_profile,
+    )
+    set_prompt_cache(llm_model, **LOCAL_MODEL_SETUPS["llm"]["prompt_cache"])
+    return llm_model
+
+
+def set_prompt_cache(
+    llama_model: Llama,
+    cache_type: str = None,
+    capacity: int = 2 << 30,
+    cache_dir: str = None,
+):
+    """Keep the llama.cpp states of the evaluated prompts, so a new prompt starts
+    from the state of its longest cached prefix instead of evaluating it again
+
+    Args:
+        llama_model (Llama): llama.cpp model
+        cache_type (str, optional): ram, disk or None (no cache). Defaults to None.
+        capacity (int, optional): cache size in bytes. Defaults to 2 << 30.
+        cache_dir (str, optional): cache directory for the disk cache. Defaults to None.
+    """
+    if cache_type == "ram":
+        llama_model.set_cache(LlamaRAMCache(capacity_bytes=capacity))
+    elif cache_type == "disk":
+        llama_model.set_cache(
+            LlamaDiskCache(cache_dir=cache_dir, capacity_bytes=capacity)
+        )
+    elif cache_type is not None:
+        raise ValueError(f"Prompt cache type {cache_type} is not supported")
+
+
+def prime_prompt_cache(code_model, query_engine: PandasQueryEngine):
+    """Evaluate the static part of the query engine prompt (system prompt, instructions
+    and the table context, i.e., everything before the question) and keep its
+    state in the prompt cache. It should be called for each data version.
+
+    Args:
+        code_model (LlamaCPP): code model with the prompt cache set, or a client
+            of the inference server (see RemoteCodeModel) priming the server model
+        query_engine (PandasQueryEngine): query engine using the code model
+    """
+    prompt = query_engine._pandas_prompt.format(
+        df_str=query_engine._get_table_context(),
+        query_str=QUERY_MARKER,
+        instruction_str=query_engine._instruction_str,
+    )
+    if callable(getattr(code_model, "prime", None)):
+        try:
+            code_model.prime(prompt)
+        except Exception as e:
+            print(f"Failed to prime the prompt cache: {e}")
+        return
+
+    prime_prompt(code_model, prompt)
+
+
+def _is_cached(cache, tokens: list) -> bool:
+    """Check if the state of exactly these tokens is in a llama.cpp prompt cache,
+    as `tokens in cache` is true for any entry sharing a prefix, e.g., the BOS
+    """
+    key = tuple(tokens)
+    if isinstance(cache, LlamaRAMCache):
+        return key in cache.cache_state
+    if isinstance(cache, LlamaDiskCache):
+        return key in cache.cache
+    return False
+
+
+def prime_prompt(code_model, prompt: str):
+    """Keep the state of the prompt before QUERY_MARKER in the prompt cache
+
+    Args:
+        code_model (LlamaCPP): code model with the prompt cache set
+        prompt (str): query engine prompt, not formatted for the model yet, with
+            QUERY_MARKER in place of the question
+    """
+    llama_model = getattr(code_model, "_model", None)
+    if llama_model is None or llama_model.cache is None:
+        return
+
+    prompt = code_model.completion_to_prompt(prompt)
+    prompt_prefix = prompt[: prompt.index(QUERY_MARKER)]
+
+    # the same as Llama.create_completion tokenizes the prompt
+    prefix_tokens = [llama_model.token_bos()] + llama_model.tokenize(
+        prompt_prefix.encode("utf-8"), add_bos=False, special=True
     )
+    if _is_cached(llama_model.cache, prefix_tokens):
+        return
+
+    try:
+        llama_model.reset()
+        llama_model.eval(prefix_tokens)
+        llama_model.cache[prefix_tokens] = llama_model.save_state()
+    except Exception as e:
+        print(f"Failed to prime the prompt cache: {e}")
+
+
+@lru_cache(maxsize=None)
+def load_grammar(grammar: str = LOCAL_MODEL_SETUPS["llm"]["grammar"]) -> LlamaGrammar:
+    """Load a GBNF grammar to constrain the LLM output
+
+    Args:
+        grammar (str, optional): grammar in GBNF. Defaults to LOCAL_MODEL_SETUPS["llm"]["grammar"].
+
+    Returns:
+        LlamaGrammar: parsed grammar
+    """
+    return LlamaGrammar.from_string(grammar, verbose=False)
 
 
 def load_code_model_local(
     llm_model_name: str = LOCAL_MODEL_SETUPS["code_model"]["path"],
     temperature: float = 0.1,
     max_new_tokens: int = 1024,
-    context_window: int = 5000,
+    context_window: int = None,
     generate_kwargs: dict = {},
-    model_kwargs: dict = {"n_gpu_layers": 30, "repetition_penalty": 1.5},
+    model_kwargs: dict = {"repetition_penalty": 1.5},
     verbose: bool = True,
+    prompt_cache: dict = LOCAL_MODEL_SETUPS["code_model"]["prompt_cache"],
+    runtime_profile: dict = None,
 ):
     """The code model we can choose from are:
 
     Args:
         llm_model_name (str, optional):
             llm model name. default is codellama-7b-instruct.Q8_0.gguf.2
+        context_window (int, optional): context size, None to use the one of
+            the runtime profile. Defaults to None.
+        prompt_cache (dict, optional): prompt cache setup, see set_prompt_cache.
+            Defaults to LOCAL_MODEL_SETUPS["code_model"]["prompt_cache"].
+        runtime_profile (dict, optional): llama.cpp settings, None to use the
+            configured one (see get_runtime_profile). Defaults to None.
 
     Returns:
         _type_: _description_
@@ -188,14 +553,48 @@ def load_code_model_local(
             f"{completion.strip()} {E_INST}"
         )
 
-    return LlamaCPP(
+    if runtime_profile is None:
+        runtime_profile = get_runtime_profile("code_model")
+    runtime_profile = dict(runtime_profile)
+    n_ctx = runtime_profile.pop("n_ctx")
+    if context_window is None:
+        context_window = n_ctx
+
+    code_model = LlamaCPP(
         model_path=llm_model_name,
         temperature=temperature,
         max_new_tokens=max_new_tokens,
         context_window=context_window,
-        generate_kwargs=generate_kwargs,
-        model_kwargs=model_kwargs,
+        # the generation of a cancelled job (see process.jobs) stops at the next token
+        generate_kwargs={
+            "stopping_criteria": StoppingCriteriaList(
+                [lambda input_ids, logits: is_cancelled()]
+            ),
+            **generate_kwargs,
+        },
+        model_kwargs={**runtime_profile, **model_kwargs},
         messages_to_prompt=_messages_to_prompt,
         completion_to_prompt=_completion_to_prompt,
         verbose=True,
     )
+    set_prompt_cache(code_model._model, **prompt_cache)
+    return code_model
+
+
+def load_small_code_model_local(
+    llm_model_name: str = LOCAL_MODEL_SETUPS["small_code_model"]["path"],
+):
+    """Load the small code model tried before the code model (see RoutedQueryEngine)
+
+    Args:
+        llm_model_name (str, optional): model path.
+            Defaults to LOCAL_MODEL_SETUPS["small_code_model"]["path"].
+
+    Returns:
+        LlamaCPP: small code model
+    """
+    return load_code_model_local(
+        llm_model_name,
+        prompt_cache=LOCAL_MODEL_SETUPS["small_code_model"]["prompt_cache"],
+        runtime_profile=get_runtime_profile("small_code_model"),
+    )
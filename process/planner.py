@@ -0,0 +1,96 @@
+from functools import lru_cache
+from re import compile as re_compile
+from re import escape
+
+from pandas import DataFrame
+from pandas.api.types import is_datetime64_any_dtype, is_numeric_dtype
+
+# words of the aggregations and the pandas methods
+AGGREGATIONS = {
+    "mean": "mean",
+    "average": "mean",
+    "avg": "mean",
+    "median": "median",
+    "max": "max",
+    "maximum": "max",
+    "highest": "max",
+    "largest": "max",
+    "min": "min",
+    "minimum": "min",
+    "lowest": "min",
+    "smallest": "min",
+    "sum": "sum",
+    "total": "sum",
+    "std": "std",
+    "standard deviation": "std",
+    "count": "count",
+    "number": "count",
+}
+
+QUESTION_PREFIX = (
+    r"(?:(?:what|which) (?:is|are|was|were) |what's |show(?: me)? |give me |get |"
+    r"find |calculate |compute |tell me )?(?:the )?"
+)
+
+
+@lru_cache(maxsize=32)
+def _question_pattern(columns: tuple):
+    """Get the pattern of the aggregate questions on the columns"""
+    aggregations = "|".join(
+        escape(word) for word in sorted(AGGREGATIONS, key=len, reverse=True)
+    )
+    column_names = "|".join(
+        escape(col) for col in sorted(columns, key=len, reverse=True)
+    )
+    return re_compile(
+        f"^{QUESTION_PREFIX}(?P<aggregation>{aggregations})(?: value)?(?: of)?"
+        f"(?: the)? (?P<column>{column_names})(?:(?: grouped)? "
+        f"(?:by|per|for each|in each|across) (?:the )?(?P<group>{column_names}))?$"
+    )
+
+
+def plan_query(prompt: str, df: DataFrame) -> str:
+    """Translate a simple aggregate question (e.g., what is the mean R.DM.Sep,
+    max PurifiedRCP/JuiceDM by Trial) into a pandas instruction, so it can be
+    answered without the code model
+
+    The whole question must match an aggregation of a column of the data
+    (optionally grouped by another column), otherwise it is left to the
+    query engine.
+
+    Args:
+        prompt (str): user prompt
+        df (DataFrame): data to be queried
+
+    Returns:
+        str: pandas instruction, None if the question is not a simple aggregate
+    """
+    question = " ".join(prompt.lower().rstrip(" ?.!").split())
+
+    columns = {}
+    for col in df.columns:
+        if isinstance(col, str):
+            # columns only differing in case are ambiguous
+            columns[col.lower()] = None if col.lower() in columns else col
+    columns = {name: col for name, col in columns.items() if col is not None}
+    if len(columns) == 0:
+        return None
+
+    match = _question_pattern(tuple(sorted(columns))).match(question)
+    if match is None:
+        return None
+
+    method = AGGREGATIONS[match["aggregation"]]
+    col = columns[match["column"]]
+    if method != "count" and not is_numeric_dtype(df[col]):
+        if method not in ["min", "max"] or not is_datetime64_any_dtype(df[col]):
+            return None
+
+    if match["group"] is None:
+        return f"df[{col!r}].{method}()"
+
+    group_col = columns[match["group"]]
+    if group_col == col:
+        return None
+
+    return f"df.groupby({group_col!r}, observed=True)[{col!r}].{method}()"
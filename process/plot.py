@@ -0,0 +1,115 @@
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from multiprocessing import get_context
+from os import listdir, makedirs, remove
+from os.path import basename, exists, join
+
+from pandas import DataFrame
+
+from process import PLOT_SERVICE
+from process.workers import init_plot_worker, render_plot
+
+
+class PlotService:
+    """Render the plotting instructions in a process pool (or an IsolatedExecutor),
+    and keep the images as files served by URL (see process.app.add_plot_route)
+
+    The images are cached by the instruction and the data version.
+    """
+
+    def __init__(
+        self,
+        df: DataFrame,
+        data_version: str,
+        workers: int = PLOT_SERVICE["workers"],
+        plot_dir: str = PLOT_SERVICE["dir"],
+        plot_url: str = PLOT_SERVICE["url"],
+        executor=None,
+        keep_images=(),
+    ):
+        """Initialize the plot service
+
+        Args:
+            df (DataFrame): data to be plotted
+            data_version (str): fingerprint of the data
+            workers (int, optional): number of processes. Defaults to PLOT_SERVICE["workers"].
+            plot_dir (str, optional): directory for the images. Defaults to PLOT_SERVICE["dir"].
+            plot_url (str, optional): URL prefix of the images. Defaults to PLOT_SERVICE["url"].
+            executor (IsolatedExecutor, optional): if set, the images are rendered by
+                its worker processes instead of a new process pool. Defaults to None.
+            keep_images (set, optional): URLs of the older images still shown,
+                which are not removed. Defaults to ().
+        """
+        self.data_version = data_version
+        self.plot_dir = plot_dir
+        self.plot_url = plot_url
+        self.isolated_executor = executor
+        self.executor = None
+        if self.isolated_executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=get_context("spawn"),
+                initializer=init_plot_worker,
+                initargs=(df,),
+            )
+
+        makedirs(self.plot_dir, exist_ok=True)
+        self.expire(keep_images)
+
+    def expire(self, keep_images=()):
+        """Remove the images which are not from the current data version
+
+        Args:
+            keep_images (set, optional): URLs of the older images still shown,
+                e.g., by the conversation history. Defaults to ().
+        """
+        for proc_file in listdir(self.plot_dir):
+            if proc_file.startswith(f"{self.data_version}_"):
+                continue
+            if f"{self.plot_url}{proc_file}" in keep_images:
+                continue
+            remove(join(self.plot_dir, proc_file))
+
+    def image_path(self, image_src: str) -> str:
+        """Get the image file of an image URL
+
+        Args:
+            image_src (str): image URL from render()
+
+        Returns:
+            str: image path
+        """
+        return join(self.plot_dir, basename(image_src))
+
+    def render(self, pandas_instruction_str: str) -> str:
+        """Render a plotting instruction
+
+        Args:
+            pandas_instruction_str (str): Pandas instruction
+
+        Returns:
+            str: image URL
+        """
+        plot_name = (
+            f"{self.data_version}_"
+            + sha256(pandas_instruction_str.encode()).hexdigest()[:16]
+            + ".png"
+        )
+        plot_path = join(self.plot_dir, plot_name)
+
+        if not exists(plot_path):
+            if self.isolated_executor is not None:
+                image_data = self.isolated_executor.render(pandas_instruction_str)
+            else:
+                image_data = self.executor.submit(
+                    render_plot, pandas_instruction_str
+                ).result()
+            with open(plot_path, "wb") as fid:
+                fid.write(image_data)
+
+        return f"{self.plot_url}{plot_name}"
+
+    def shutdown(self):
+        """Stop the rendering processes"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,256 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread, Timer
+from time import sleep, time
+
+from process import DATASET_REGISTRY
+
+
+class DatasetRegistry:
+    """Datasets (data with its executor, plot service and query engine) loaded on
+    first use and kept in an LRU bounded by the number of datasets and their
+    memory. The least recently used datasets, and the ones idle for too long,
+    are released.
+    """
+
+    def __init__(
+        self,
+        loader,
+        max_datasets: int = DATASET_REGISTRY["max_datasets"],
+        max_memory: int = DATASET_REGISTRY["max_memory"],
+        idle_time: float = DATASET_REGISTRY["idle_time"],
+        evict_interval: float = DATASET_REGISTRY["evict_interval"],
+    ):
+        """Initialize the dataset registry
+
+        Args:
+            loader (callable): called with the dataset (dict) and its name in a background
+                thread, it sets the data and records the status of each component
+            max_datasets (int, optional): maximum datasets to be kept.
+                Defaults to DATASET_REGISTRY["max_datasets"].
+            max_memory (int, optional): maximum memory of the kept data in bytes.
+                Defaults to DATASET_REGISTRY["max_memory"].
+            idle_time (float, optional): seconds after which an unused dataset is
+                released. Defaults to DATASET_REGISTRY["idle_time"].
+            evict_interval (float, optional): seconds between the checks of the idle
+                datasets in a background thread, None to only check them on use.
+                Defaults to DATASET_REGISTRY["evict_interval"].
+        """
+        self.loader = loader
+        self.max_datasets = max_datasets
+        self.max_memory = max_memory
+        self.idle_time = idle_time
+        self.datasets = OrderedDict()
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loads = 0
+        self.evictions = 0
+
+        self.evict_interval = evict_interval
+        if evict_interval is not None:
+            Thread(target=self._evict_idle, daemon=True).start()
+
+    def get(self, name: str) -> dict:
+        """Get a dataset, start loading it if it is not kept
+
+        Args:
+            name (str): dataset name, see DATASETS
+
+        Returns:
+            dict: dataset with status of data and query_engine, check the status
+                (e.g., with is_ready) before using it
+        """
+        with self.lock:
+            if name in self.datasets:
+                self.datasets.move_to_end(name)
+                dataset = self.datasets[name]
+            else:
+                dataset = {
+                    "name": name,
+                    "status": {
+                        component: {"ready": False, "load_time": None, "error": None}
+                        for component in ["data", "query_engine"]
+                    },
+                    "memory": 0,
+                }
+                self.datasets[name] = dataset
+                self.loads += 1
+                self.executor.submit(self._load, dataset)
+
+            dataset["last_used"] = time()
+            self._evict()
+
+        return dataset
+
+    def remove(self, name: str) -> dict:
+        """Remove a dataset, e.g., its workbook has changed, so it is loaded
+        again on the next use
+
+        Args:
+            name (str): dataset name
+
+        Returns:
+            dict: removed dataset to be released (see release_dataset), None if it is not kept
+        """
+        with self.lock:
+            return self.datasets.pop(name, None)
+
+    def evict(self):
+        """Release the datasets which are idle for too long or over the limits"""
+        with self.lock:
+            self._evict()
+
+    def _evict_idle(self):
+        while True:
+            sleep(self.evict_interval)
+            try:
+                self.evict()
+            except Exception as e:
+                print(f"Not able to release the idle datasets: {e}")
+
+    def _load(self, dataset: dict):
+        try:
+            self.loader(dataset, dataset["name"])
+        except Exception as e:
+            print(f"Not able to load dataset {dataset['name']}: {e}")
+            # a failed dataset is loaded again on the next use
+            with self.lock:
+                if self.datasets.get(dataset["name"]) is dataset:
+                    self.datasets.pop(dataset["name"])
+            return
+
+        if "data" in dataset:
+            dataset["memory"] = int(dataset["data"].memory_usage(deep=True).sum())
+        with self.lock:
+            self._evict()
+
+    def _is_loading(self, dataset: dict) -> bool:
+        return not all(status["ready"] for status in dataset["status"].values())
+
+    def _evict(self):
+        now = time()
+        names = list(self.datasets)
+        for name in names:
+            dataset = self.datasets[name]
+            if self._is_loading(dataset):
+                continue
+
+            # the most recently used dataset is only released when idle
+            over_limit = name != names[-1] and (
+                len(self.datasets) > self.max_datasets
+                or sum(kept["memory"] for kept in self.datasets.values())
+                > self.max_memory
+            )
+            if over_limit or now - dataset["last_used"] > self.idle_time:
+                self.datasets.pop(name)
+                self.evictions += 1
+                release_dataset(dataset)
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "kept": len(self.datasets),
+                "memory": sum(dataset["memory"] for dataset in self.datasets.values()),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+class DatasetUsers:
+    """Count the requests using the worker processes of a data version, so a
+    released dataset is only stopped after its last request is done
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.stop = None
+        self.lock = Lock()
+
+    def acquire(self):
+        """A request starts using the dataset"""
+        with self.lock:
+            self.count += 1
+
+    def release(self):
+        """A request stops using the dataset, it is stopped if it has been released"""
+        with self.lock:
+            self.count -= 1
+            stop = self.stop if self.count == 0 else None
+            if stop is not None:
+                self.stop = None
+        if stop is not None:
+            stop()
+
+    def stop_when_unused(self, stop, grace_time: float = None):
+        """Stop the dataset now if it is not used, otherwise after its last
+        request or the grace time, whichever comes first
+
+        Args:
+            stop (callable): function stopping the dataset
+            grace_time (float, optional): maximum seconds to wait for the requests,
+                None to wait until they are done. Defaults to None.
+        """
+        with self.lock:
+            if self.count > 0:
+                self.stop = stop
+                if grace_time is not None:
+                    Timer(grace_time, self._force_stop).start()
+                return
+        stop()
+
+    def _force_stop(self):
+        with self.lock:
+            stop, self.stop = self.stop, None
+        if stop is not None:
+            print("Requests are still using the released dataset, stop it ...")
+            stop()
+
+
+@contextmanager
+def hold_dataset(dataset: dict):
+    """Keep the worker processes of a dataset while a request uses it, e.g.,
+
+        with hold_dataset(data_and_model):
+            ...
+
+    Args:
+        dataset (dict): dataset (or data and model) used by the request
+    """
+    users = dataset.get("users")
+    if users is None:
+        yield
+        return
+
+    users.acquire()
+    try:
+        yield
+    finally:
+        users.release()
+
+
+def _stop_dataset(dataset: dict):
+    print(f"Dataset {dataset['name']} is released ...")
+    for service in ["executor", "plot_service"]:
+        if dataset.get(service) is not None:
+            dataset[service].shutdown()
+
+    for key in ["data", "query_engine", "executor", "plot_service", "semantic_cache"]:
+        dataset.pop(key, None)
+
+
+def release_dataset(dataset: dict, grace_time: float = None):
+    """Stop the worker processes of a dataset and drop its data, once the
+    requests holding it (see hold_dataset) are done
+
+    Args:
+        dataset (dict): dataset to be released
+        grace_time (float, optional): maximum seconds to wait for the requests,
+            None to wait until they are done. Defaults to None.
+    """
+    users = dataset.get("users")
+    if users is None:
+        _stop_dataset(dataset)
+    else:
+        users.stop_when_unused(lambda: _stop_dataset(dataset), grace_time)
@@ -0,0 +1,222 @@
+from itertools import product
+from json import dump as json_dump
+from json import load as json_load
+from os import cpu_count, makedirs
+from os.path import dirname, exists
+from platform import platform
+from time import time
+
+from llama_cpp import Llama, llama_supports_gpu_offload
+
+from process import RUNTIME_PROFILES, WARM_UP
+
+# filler of the benchmark prompt, similar to the df.head() context
+TUNING_TEXT = (
+    "Trial Crop R.DM.Sep PurifiedRCP/JuiceDM JuiceDM FinalDM "
+    "1 Clover 0.52 0.71 4.9 23 2 Kale 0.48 0.66 5.2 31 "
+)
+
+
+def load_saved_profiles(profile_path: str = RUNTIME_PROFILES["path"]) -> dict:
+    """Load the profiles saved by the auto-tuning (see save_runtime_profile)
+
+    Args:
+        profile_path (str, optional): profile file. Defaults to RUNTIME_PROFILES["path"].
+
+    Returns:
+        dict: saved profiles of each model, {} if there is none
+    """
+    if not exists(profile_path):
+        return {}
+    with open(profile_path) as fid:
+        return json_load(fid)
+
+
+def get_runtime_profile(
+    model: str,
+    profile: str = RUNTIME_PROFILES["profile"],
+    profile_path: str = RUNTIME_PROFILES["path"],
+) -> dict:
+    """Get the llama.cpp settings of a model
+
+    Args:
+        model (str): code_model, small_code_model or llm
+        profile (str, optional): auto, cpu or gpu. Defaults to RUNTIME_PROFILES["profile"].
+        profile_path (str, optional): file of the tuned profiles. Defaults to RUNTIME_PROFILES["path"].
+
+    Raises:
+        ValueError: Profile is not supported
+
+    Returns:
+        dict: n_gpu_layers, n_ctx, n_threads, n_batch, use_mmap and use_mlock
+    """
+    runtime_profile = None
+    if profile == "auto":
+        saved_profiles = load_saved_profiles(profile_path)
+        if model in saved_profiles:
+            runtime_profile = dict(saved_profiles[model]["profile"])
+        else:
+            profile = "gpu" if llama_supports_gpu_offload() else "cpu"
+
+    if runtime_profile is None:
+        if profile not in ["cpu", "gpu"]:
+            raise ValueError(f"Runtime profile {profile} is not supported")
+        runtime_profile = dict(RUNTIME_PROFILES[profile][model])
+
+    # the weights are locked in memory while loading for the warm start
+    if WARM_UP["enable"] and WARM_UP["weights"] == "mlock":
+        runtime_profile["use_mlock"] = True
+
+    return runtime_profile
+
+
+def measure_throughput(
+    model_path: str,
+    profile: dict,
+    prompt_tokens: int = 1024,
+    decode_tokens: int = 32,
+) -> dict:
+    """Measure the prefill (prompt) and decode (generation) throughput of a model
+
+    Args:
+        model_path (str): GGUF model path
+        profile (dict): llama.cpp settings, see get_runtime_profile
+        prompt_tokens (int, optional): prompt length. Defaults to 1024.
+        decode_tokens (int, optional): generated tokens. Defaults to 32.
+
+    Raises:
+        ValueError: The prompt and generated tokens do not fit in the context
+
+    Returns:
+        dict: prefill and decode tokens per second, and the load time
+    """
+    if prompt_tokens + decode_tokens > profile["n_ctx"]:
+        raise ValueError(
+            f"{prompt_tokens} prompt and {decode_tokens} generated tokens "
+            f"do not fit in the context of {profile['n_ctx']} tokens"
+        )
+
+    start_t = time()
+    llama_model = Llama(model_path=model_path, verbose=False, **profile)
+    load_time = time() - start_t
+
+    tokens = llama_model.tokenize(TUNING_TEXT.encode("utf-8"))
+    tokens = (tokens * (prompt_tokens // len(tokens) + 1))[:prompt_tokens]
+
+    start_t = time()
+    llama_model.eval(tokens)
+    prefill_time = time() - start_t
+
+    start_t = time()
+    for _ in range(decode_tokens):
+        llama_model.eval([llama_model.sample(temp=0.0)])
+    decode_time = time() - start_t
+
+    del llama_model
+    return {
+        "load_time": load_time,
+        "prefill_tokens_per_second": prompt_tokens / prefill_time,
+        "decode_tokens_per_second": decode_tokens / decode_time,
+    }
+
+
+def tune_runtime_profile(
+    model: str,
+    model_path: str,
+    threads: list,
+    batches: list,
+    contexts: list,
+    prompt_tokens: int = 1024,
+    decode_tokens: int = 32,
+    min_ctx: int = None,
+) -> tuple:
+    """Benchmark the thread, batch and context settings of a model on this machine
+
+    The settings are ranked by the latency of a typical question, i.e., the
+    prefill of prompt_tokens plus the decode of decode_tokens. The contexts
+    smaller than min_ctx, or than the typical question, are skipped, as a
+    smaller context is faster but does not fit the prompts.
+
+    Args:
+        model (str): code_model, small_code_model or llm
+        model_path (str): GGUF model path
+        threads (list): numbers of threads
+        batches (list): batch sizes
+        contexts (list): context sizes
+        prompt_tokens (int, optional): prompt length. Defaults to 1024.
+        decode_tokens (int, optional): generated tokens. Defaults to 32.
+        min_ctx (int, optional): minimum context size. Defaults to None
+            (RUNTIME_PROFILES["min_ctx"] of the model).
+
+    Returns:
+        tuple: the fastest profile and the results of all the settings
+    """
+    if min_ctx is None:
+        min_ctx = RUNTIME_PROFILES["min_ctx"][model]
+    min_ctx = max(min_ctx, prompt_tokens + decode_tokens)
+
+    base_profile = get_runtime_profile(model, profile="auto")
+    results = []
+    for n_threads, n_batch, n_ctx in product(threads, batches, contexts):
+        if n_ctx < min_ctx:
+            print(f"Context {n_ctx} is skipped, smaller than {min_ctx} tokens ...")
+            continue
+
+        # locking the weights only slows down the loading of each setting
+        profile = dict(
+            base_profile,
+            n_threads=n_threads,
+            n_batch=n_batch,
+            n_ctx=n_ctx,
+            use_mlock=False,
+        )
+        try:
+            result = measure_throughput(
+                model_path, profile, prompt_tokens, decode_tokens
+            )
+        except Exception as e:
+            print(f"Not able to run {profile}: {e}")
+            continue
+
+        result["latency"] = (
+            prompt_tokens / result["prefill_tokens_per_second"]
+            + decode_tokens / result["decode_tokens_per_second"]
+        )
+        print(
+            f"threads {n_threads}, batch {n_batch}, context {n_ctx}: "
+            f"prefill {result['prefill_tokens_per_second']:.1f} tokens/s, "
+            f"decode {result['decode_tokens_per_second']:.1f} tokens/s ..."
+        )
+        results.append({"profile": profile, **result})
+
+    if len(results) == 0:
+        raise Exception(f"None of the settings of {model} can be run ...")
+
+    return min(results, key=lambda result: result["latency"])["profile"], results
+
+
+def save_runtime_profile(
+    model: str,
+    profile: dict,
+    results: list,
+    profile_path: str = RUNTIME_PROFILES["path"],
+):
+    """Save the tuned profile of a model, the loaders use it with the auto profile
+
+    Args:
+        model (str): code_model, small_code_model or llm
+        profile (dict): the fastest profile
+        results (list): results of all the settings
+        profile_path (str, optional): profile file. Defaults to RUNTIME_PROFILES["path"].
+    """
+    saved_profiles = load_saved_profiles(profile_path)
+    saved_profiles[model] = {
+        "profile": profile,
+        "machine": {"platform": platform(), "cpu_count": cpu_count()},
+        "results": results,
+    }
+
+    if dirname(profile_path):
+        makedirs(dirname(profile_path), exist_ok=True)
+    with open(profile_path, "w") as fid:
+        json_dump(saved_profiles, fid, indent=2)
@@ -0,0 +1,246 @@
+from re import compile as re_compile
+
+import numpy as np
+from pandas import DataFrame, Series
+from pandas.api.types import (
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_numeric_dtype,
+)
+
+from process import PROMPT_CONTEXT
+
+# llama tokenizers split the numbers into digits, so a digit, a word or a
+# punctuation mark is roughly a token
+TOKEN_PATTERN = re_compile(r"\d|[^\W\d]+|[^\w\s]")
+WORD_PATTERN = re_compile(r"[a-z0-9]+")
+UNIT_PATTERN = re_compile(r"[(\[]([^()\[\]]+)[)\]]\s*$")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text without the tokenizer
+
+    Args:
+        text (str): text to be tokenized
+
+    Returns:
+        int: estimated number of tokens
+    """
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def column_unit(col: str, units: dict = PROMPT_CONTEXT["units"]) -> str:
+    """Get the unit of a column, from the configured units or the column name, e.g., Yield (t/ha)
+
+    Args:
+        col (str): column name
+        units (dict, optional): units of the columns. Defaults to PROMPT_CONTEXT["units"].
+
+    Returns:
+        str: unit, None if it is unknown
+    """
+    if col in units:
+        return units[col]
+    match = UNIT_PATTERN.search(str(col))
+    return match[1].strip() if match is not None else None
+
+
+def _format_value(value) -> str:
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.3g}"
+    return repr(value.item() if isinstance(value, np.generic) else value)
+
+
+def summarize_column(
+    series: Series, unit: str = None, examples: int = PROMPT_CONTEXT["examples"]
+) -> tuple:
+    """Summarize a column of the data for the code model
+
+    Args:
+        series (Series): column to be summarized
+        unit (str, optional): unit of the column. Defaults to None.
+        examples (int, optional): maximum example values. Defaults to PROMPT_CONTEXT["examples"].
+
+    Returns:
+        tuple: the full line (with the example values of the non-numeric columns)
+            and the short line
+    """
+    values = series.dropna()
+    description = f"- {series.name!r}: {series.dtype}"
+    if unit is not None:
+        description += f", unit {unit}"
+
+    if len(values) == 0:
+        return f"{description}, empty", f"{description}, empty"
+
+    # the range is enough for the numbers and dates
+    if is_numeric_dtype(values) and not is_bool_dtype(values):
+        line = f"{description}, {_format_value(values.min())} to {_format_value(values.max())}"
+        return line, line
+    if is_datetime64_any_dtype(values):
+        line = f"{description}, {values.min()} to {values.max()}"
+        return line, line
+
+    description += f", {values.nunique()} distinct values"
+    example_values = ", ".join(
+        _format_value(value) for value in values.drop_duplicates()[:examples]
+    )
+    return f"{description}, e.g. {example_values}", description
+
+
+class SchemaContext:
+    """Compact schema summary of the data (column names, data types, units,
+    ranges and example values), used as the code model context instead of
+    the df.head() dump of the wide sheets.
+
+    The summary is computed once for a data version and fitted into a token
+    budget. With select_columns, only the columns relevant to the question
+    (by name, value or embedding match) are kept, which shortens the prompt
+    but changes it with the question, so the prompt cache only keeps the part
+    before the context.
+    """
+
+    def __init__(
+        self,
+        df: DataFrame,
+        embed_model=None,
+        max_tokens: int = PROMPT_CONTEXT["max_tokens"],
+        examples: int = PROMPT_CONTEXT["examples"],
+        select_columns: bool = PROMPT_CONTEXT["select_columns"],
+        max_columns: int = PROMPT_CONTEXT["max_columns"],
+        units: dict = PROMPT_CONTEXT["units"],
+    ):
+        """Initialize the schema context
+
+        Args:
+            df (DataFrame): data to be summarized
+            embed_model (HuggingFaceEmbedding, optional): embedding model to match the
+                questions with the column names, None to match the names and values only.
+                Defaults to None.
+            max_tokens (int, optional): token budget of the context. Defaults to PROMPT_CONTEXT["max_tokens"].
+            examples (int, optional): example values of each column. Defaults to PROMPT_CONTEXT["examples"].
+            select_columns (bool, optional): if only the columns relevant to the question
+                are kept. Defaults to PROMPT_CONTEXT["select_columns"].
+            max_columns (int, optional): maximum columns kept with select_columns.
+                Defaults to PROMPT_CONTEXT["max_columns"].
+            units (dict, optional): units of the columns. Defaults to PROMPT_CONTEXT["units"].
+        """
+        self.max_tokens = max_tokens
+        self.select_columns = select_columns
+        self.max_columns = max_columns
+        self.embed_model = embed_model
+        self.header = f"{len(df)} rows, {len(df.columns)} columns:"
+
+        self.columns = list(df.columns)
+        self.lines = {}
+        self.words = {}
+        for col in self.columns:
+            full_line, short_line = summarize_column(
+                df[col], column_unit(col, units), examples
+            )
+            self.lines[col] = (
+                (full_line, estimate_tokens(full_line)),
+                (short_line, estimate_tokens(short_line)),
+            )
+
+            # the question can name a column or one of its (categorical) values
+            words = set(WORD_PATTERN.findall(str(col).lower()))
+            if not is_numeric_dtype(df[col]) and df[col].nunique() <= 50:
+                for value in df[col].dropna().unique():
+                    words.update(
+                        word
+                        for word in WORD_PATTERN.findall(str(value).lower())
+                        if not word.isdigit()
+                    )
+            self.words[col] = words
+
+        self.column_embeddings = None
+        if select_columns and embed_model is not None:
+            embeddings = np.asarray(
+                embed_model.get_text_embedding_batch(
+                    [str(col) for col in self.columns]
+                ),
+                dtype=np.float32,
+            )
+            self.column_embeddings = embeddings / np.maximum(
+                np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+            )
+
+        self.full_context = self._fit(self.columns)
+
+    def relevant_columns(self, question: str) -> list:
+        """Get the columns relevant to a question, the ones sharing words with it
+        first, then the closest ones by embedding
+
+        Args:
+            question (str): user question
+
+        Returns:
+            list: relevant columns in the data order, all the columns if none is found
+        """
+        question_words = set(WORD_PATTERN.findall(question.lower()))
+        scores = {col: len(self.words[col] & question_words) for col in self.columns}
+        columns = sorted(
+            (col for col in self.columns if scores[col] > 0),
+            key=lambda col: -scores[col],
+        )[: self.max_columns]
+
+        if self.column_embeddings is not None and len(columns) < self.max_columns:
+            embedding = np.asarray(
+                self.embed_model.get_query_embedding(question), dtype=np.float32
+            )
+            similarity = self.column_embeddings @ embedding
+            for index in np.argsort(-similarity):
+                if len(columns) >= self.max_columns:
+                    break
+                if self.columns[index] not in columns:
+                    columns.append(self.columns[index])
+
+        if len(columns) == 0:
+            return self.columns
+
+        columns = set(columns)
+        return [col for col in self.columns if col in columns]
+
+    def _fit(self, columns: list) -> str:
+        """Fit the summary of the columns into the token budget: the example values
+        are dropped first, then the columns are only named"""
+        lines = [self.header]
+        tokens = estimate_tokens(self.header)
+        named_columns = []
+        for col in columns:
+            for line, line_tokens in self.lines[col]:
+                if tokens + line_tokens <= self.max_tokens:
+                    lines.append(line)
+                    tokens += line_tokens
+                    break
+            else:
+                named_columns.append(repr(col))
+
+        if len(named_columns) > 0:
+            lines.append(f"- other columns: {', '.join(named_columns)}")
+
+        if len(columns) < len(self.columns):
+            lines.append(
+                f"({len(self.columns) - len(columns)} columns "
+                "not relevant to the query are not shown)"
+            )
+        return "\n".join(lines)
+
+    def build(self, question: str = None) -> str:
+        """Get the context of a question
+
+        Args:
+            question (str, optional): user question, None for the context of all
+                the columns. Defaults to None.
+
+        Returns:
+            str: schema summary
+        """
+        if not self.select_columns or question is None:
+            return self.full_context
+
+        columns = self.relevant_columns(question)
+        if len(columns) == len(self.columns):
+            return self.full_context
+        return self._fit(columns)
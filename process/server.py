@@ -0,0 +1,454 @@
+from json import dumps as json_dumps
+from json import loads as json_loads
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import time
+from typing import Any
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+from flask import Flask, Response, jsonify, request
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from process import INFERENCE_SERVER
+from process.jobs import check_cancelled, current_job
+from process.metrics import metrics
+from process.model import load_grammar, prime_prompt
+
+
+class InferenceServer:
+    """Keep one copy of the code model and the LLM and serve the requests of
+    all the web workers. The requests of each model are queued and taken in
+    batches, the identical requests in a batch share one generation and the
+    others are run one after another in the order of their prompts, so the
+    prompts with the same prefix reuse the llama.cpp prompt cache.
+
+    A request with a request_id can be cancelled: it is dropped if it is still
+    queued, and its generation stops at the next token (see the stopping
+    criteria of load_code_model_local) once all its identical requests are
+    cancelled.
+    """
+
+    def __init__(
+        self,
+        code_model=None,
+        llm_model=None,
+        small_code_model=None,
+        batch_size: int = INFERENCE_SERVER["batch_size"],
+        batch_wait: float = INFERENCE_SERVER["batch_wait"],
+    ):
+        """Initialize the inference server
+
+        Args:
+            code_model (LlamaCPP, optional): code model, see load_code_model_local. Defaults to None.
+            llm_model (Llama, optional): LLM, see load_llm_model_local. Defaults to None.
+            small_code_model (LlamaCPP, optional): small code model, see
+                load_small_code_model_local. Defaults to None.
+            batch_size (int, optional): maximum requests in a batch. Defaults to INFERENCE_SERVER["batch_size"].
+            batch_wait (float, optional): seconds to wait for more requests after
+                the first one of a batch. Defaults to INFERENCE_SERVER["batch_wait"].
+        """
+        self.models = {
+            "code_model": code_model,
+            "llm_model": llm_model,
+            "small_code_model": small_code_model,
+        }
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queues = {model: Queue() for model in self.models}
+        self.stats = {
+            model: {"requests": 0, "batches": 0, "generations": 0}
+            for model in self.models
+        }
+        self.requests = {}
+        self.lock = Lock()
+
+        for model in self.models:
+            Thread(target=self._serve, args=(model,), daemon=True).start()
+
+    def submit(self, model: str, inputs: dict) -> Queue:
+        """Queue a request
+
+        Args:
+            model (str): code_model, small_code_model or llm_model
+            inputs (dict): prompt and generation arguments of the model
+
+        Raises:
+            ValueError: Model is not served
+
+        Returns:
+            Queue: outputs of the request, ended by None
+        """
+        if self.models.get(model) is None:
+            raise ValueError(f"{model} is not served")
+
+        outputs = Queue()
+        self.stats[model]["requests"] += 1
+        if inputs.get("request_id") is not None:
+            with self.lock:
+                self.requests[inputs["request_id"]] = {
+                    "cancelled": False,
+                    "generation": None,
+                }
+        self.queues[model].put((inputs, outputs))
+        return outputs
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel a request
+
+        Args:
+            request_id (str): request_id of the inputs of the request
+
+        Returns:
+            bool: if the request is queued or running, False if it is done or unknown
+        """
+        with self.lock:
+            state = self.requests.get(request_id)
+            if state is None:
+                return False
+            state["cancelled"] = True
+            generation = state["generation"]
+            if generation is not None and all(
+                self.requests[other_id]["cancelled"]
+                for other_id in generation["request_ids"]
+            ):
+                generation["cancelled"] = True
+        return True
+
+    def _start_generation(self, subscribers: list) -> tuple:
+        """Drop the cancelled requests of a generation, and get the job of the
+        generation read by is_cancelled, None if it cannot be cancelled
+        """
+        with self.lock:
+            running = []
+            for request_id, outputs in subscribers:
+                if request_id is not None and self.requests[request_id]["cancelled"]:
+                    self.requests.pop(request_id)
+                    outputs.put({"error": "The request has been cancelled"})
+                    outputs.put(None)
+                else:
+                    running.append((request_id, outputs))
+
+            request_ids = [request_id for request_id, _ in running]
+            if len(running) == 0 or None in request_ids:
+                return running, None
+
+            generation = {"cancelled": False, "request_ids": request_ids}
+            for request_id in request_ids:
+                self.requests[request_id]["generation"] = generation
+            return running, generation
+
+    def _end_generation(self, subscribers: list):
+        with self.lock:
+            for request_id, _ in subscribers:
+                if request_id is not None:
+                    self.requests.pop(request_id, None)
+
+    def _next_batch(self, model: str) -> list:
+        batch = [self.queues[model].get()]
+        deadline = time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queues[model].get(timeout=max(deadline - time(), 0)))
+            except Empty:
+                break
+        return batch
+
+    def _serve(self, model: str):
+        while True:
+            batch = self._next_batch(model)
+            self.stats[model]["batches"] += 1
+            metrics.observe("inference_batch_size", len(batch), model=model)
+
+            requests = {}
+            for inputs, outputs in batch:
+                inputs = dict(inputs)
+                request_id = inputs.pop("request_id", None)
+                key = json_dumps(inputs, sort_keys=True)
+                requests.setdefault(key, (inputs, []))[1].append((request_id, outputs))
+
+            for inputs, subscribers in sorted(
+                requests.values(), key=lambda item: item[0]["prompt"]
+            ):
+                subscribers, generation = self._start_generation(subscribers)
+                if len(subscribers) == 0:
+                    continue
+
+                self.stats[model]["generations"] += 1
+                current_job.job = generation
+                try:
+                    with metrics.span(f"inference_{model}"):
+                        for output in self._generate(model, inputs):
+                            for _, outputs in subscribers:
+                                outputs.put(output)
+                except Exception as e:
+                    print(f"Inference of {model} failed: {e}")
+                    for _, outputs in subscribers:
+                        outputs.put({"error": str(e)})
+                finally:
+                    current_job.job = None
+                    self._end_generation(subscribers)
+                for _, outputs in subscribers:
+                    outputs.put(None)
+
+    def _generate(self, model: str, inputs: dict):
+        if inputs.get("prime", False):
+            prime_prompt(self.models[model], inputs["prompt"])
+            yield {}
+            return
+
+        if model in ["code_model", "small_code_model"]:
+            response = self.models[model].complete(
+                inputs["prompt"], formatted=inputs.get("formatted", False)
+            )
+            yield {"text": response.text, "raw": response.raw}
+            return
+
+        kwargs = dict(inputs.get("kwargs", {}))
+        if inputs.get("grammar", False):
+            kwargs["grammar"] = load_grammar()
+        if inputs.get("stream", False):
+            yield from self.models[model](inputs["prompt"], stream=True, **kwargs)
+        else:
+            yield self.models[model](inputs["prompt"], **kwargs)
+
+
+def create_server(inference_server: InferenceServer) -> Flask:
+    """Create the HTTP app of the inference server
+
+    The outputs of a request are returned as JSON lines, one per streamed chunk.
+    /v1/<model>/prime primes the prompt cache of a code model with a prompt
+    (see prime_prompt) and /v1/<model>/cancel cancels a request by its request_id.
+
+    Args:
+        inference_server (InferenceServer): inference server
+
+    Returns:
+        Flask: HTTP app
+    """
+    server = Flask(__name__)
+
+    def _respond(model: str, inputs: dict):
+        try:
+            outputs = inference_server.submit(model, inputs)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404
+
+        def _outputs():
+            while True:
+                output = outputs.get()
+                if output is None:
+                    break
+                yield json_dumps(output) + "\n"
+
+        return Response(_outputs(), mimetype="application/x-ndjson")
+
+    @server.route("/v1/<model>", methods=["POST"])
+    def generate(model):
+        return _respond(model, request.get_json())
+
+    @server.route("/v1/<model>/prime", methods=["POST"])
+    def prime(model):
+        # run by the serving thread of the model, not along a generation
+        return _respond(model, {"prompt": request.get_json()["prompt"], "prime": True})
+
+    @server.route("/v1/<model>/cancel", methods=["POST"])
+    def cancel(model):
+        return jsonify(
+            {"cancelled": inference_server.cancel(request.get_json()["request_id"])}
+        )
+
+    @server.route("/health")
+    def health():
+        return jsonify(
+            {
+                "models": {
+                    model: inference_server.models[model] is not None
+                    for model in inference_server.models
+                },
+                "stats": inference_server.stats,
+            }
+        )
+
+    @server.route("/metrics")
+    def metrics_route():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return server
+
+
+def _post(url: str, inputs: dict, timeout: float):
+    """Send a request to the inference server and yield its outputs
+
+    Raises:
+        Exception: Inference failed on the server
+    """
+    http_request = Request(
+        url,
+        data=json_dumps(inputs).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlopen(http_request, timeout=timeout) as http_response:
+        for line in http_response:
+            output = json_loads(line)
+            if "error" in output:
+                raise Exception(f"Inference server error: {output['error']}")
+            yield output
+
+
+class RemoteCodeModel(CustomLLM):
+    """Client of the code model on the inference server, used by the query engine
+    in place of the LlamaCPP model (see load_code_model_local)
+    """
+
+    url: str = INFERENCE_SERVER["url"]
+    model: str = "code_model"
+    timeout: float = INFERENCE_SERVER["timeout"]
+    context_window: int = 5000
+    num_output: int = 1024
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.num_output,
+            model_name=f"remote-{self.model}",
+        )
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        # the completion_to_prompt of this client is the identity, so a prompt
+        # "formatted" here is still raw and the server model wraps it with the
+        # CodeLlama template as in the local path
+        inputs = {"prompt": prompt, "formatted": False}
+
+        # the generation of a cancelled job (see process.jobs) is cancelled on the server
+        job = getattr(current_job, "job", None)
+        done = Event()
+        if job is not None:
+            check_cancelled()
+            inputs["request_id"] = uuid4().hex
+            Thread(
+                target=self._cancel_on,
+                args=(job, inputs["request_id"], done),
+                daemon=True,
+            ).start()
+
+        try:
+            (output,) = list(_post(f"{self.url}/v1/{self.model}", inputs, self.timeout))
+        except Exception:
+            check_cancelled()
+            raise
+        finally:
+            done.set()
+        return CompletionResponse(text=output["text"], raw=output["raw"])
+
+    def _cancel_on(self, job: dict, request_id: str, done: Event):
+        while not done.wait(0.1):
+            if job["cancelled"]:
+                try:
+                    list(
+                        _post(
+                            f"{self.url}/v1/{self.model}/cancel",
+                            {"request_id": request_id},
+                            self.timeout,
+                        )
+                    )
+                except Exception as e:
+                    print(f"Not able to cancel the inference request: {e}")
+                return
+
+    def prime(self, prompt: str):
+        """Prime the prompt cache of the model on the server, see prime_prompt
+
+        Args:
+            prompt (str): query engine prompt with QUERY_MARKER in place of the question
+        """
+        list(
+            _post(f"{self.url}/v1/{self.model}/prime", {"prompt": prompt}, self.timeout)
+        )
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        response = self.complete(prompt, formatted=formatted, **kwargs)
+        yield CompletionResponse(
+            text=response.text, delta=response.text, raw=response.raw
+        )
+
+
+class RemoteLlama:
+    """Client of the LLM on the inference server, called like llama_cpp.Llama
+    (see load_llm_model_local). A grammar is replaced by the configured one
+    (LOCAL_MODEL_SETUPS["llm"]["grammar"]) on the server.
+    """
+
+    def __init__(
+        self,
+        url: str = INFERENCE_SERVER["url"],
+        timeout: float = INFERENCE_SERVER["timeout"],
+    ):
+        """Initialize the client
+
+        Args:
+            url (str, optional): inference server URL. Defaults to INFERENCE_SERVER["url"].
+            timeout (float, optional): request timeout in seconds. Defaults to INFERENCE_SERVER["timeout"].
+        """
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, prompt: str, stream: bool = False, grammar=None, **kwargs):
+        outputs = _post(
+            f"{self.url}/v1/llm_model",
+            {
+                "prompt": prompt,
+                "stream": stream,
+                "grammar": grammar is not None,
+                "kwargs": kwargs,
+            },
+            self.timeout,
+        )
+        if stream:
+            return outputs
+        (output,) = list(outputs)
+        return output
+
+
+def load_code_model_remote(
+    url: str = INFERENCE_SERVER["url"],
+    timeout: float = INFERENCE_SERVER["timeout"],
+    model: str = "code_model",
+) -> RemoteCodeModel:
+    """Connect to the code model on the inference server
+
+    Args:
+        url (str, optional): inference server URL. Defaults to INFERENCE_SERVER["url"].
+        timeout (float, optional): request timeout in seconds. Defaults to INFERENCE_SERVER["timeout"].
+        model (str, optional): code_model or small_code_model. Defaults to "code_model".
+
+    Returns:
+        RemoteCodeModel: code model client
+    """
+    return RemoteCodeModel(url=url, timeout=timeout, model=model)
+
+
+def load_llm_model_remote(
+    url: str = INFERENCE_SERVER["url"], timeout: float = INFERENCE_SERVER["timeout"]
+) -> RemoteLlama:
+    """Connect to the LLM on the inference server
+
+    Args:
+        url (str, optional): inference server URL. Defaults to INFERENCE_SERVER["url"].
+        timeout (float, optional): request timeout in seconds. Defaults to INFERENCE_SERVER["timeout"].
+
+    Returns:
+        RemoteLlama: LLM client
+    """
+    return RemoteLlama(url=url, timeout=timeout)
@@ -1,84 +1,481 @@
+from base64 import b64encode
+from time import time
+
 import dash_html_components as html
+from dash import Patch, no_update
+
+from process import DASHBOARD_STYLE, LOCAL_MODEL_SETUPS, QUERY_PLANNER
+from process.cache import prompt_terms
+from process.jobs import check_cancelled
+from process.metrics import metrics
+from process.model import INSTRUCTION_ERROR, clean_instruction, load_grammar
+from process.planner import plan_query
+from process.registry import hold_dataset
+from process.utils import create_img, replace_substrings, run_pandas_instruction
+from process.wrapper import is_ready
+
+
+def summarize_response(
+    prompt: str,
+    response: str,
+    llm_model,
+    on_progress=None,
+    stats: dict = None,
+    max_tokens: int = LOCAL_MODEL_SETUPS["llm"]["max_tokens"],
+    timeout: float = LOCAL_MODEL_SETUPS["llm"]["timeout"],
+) -> str:
+    """Combine the question and the answer into one sentence with LLM
+
+    The output is constrained by a grammar so one pass gives a sentence. If the
+    sentence is not completed within the token and time budget, the answer from
+    the query engine is used instead.
+
+    Args:
+        prompt (str): user prompt
+        response (str): answer from the query engine
+        llm_model (Llama): LLM model
+        on_progress (callable, optional): called with the partial answer
+            while the tokens are being generated. Defaults to None.
+        stats (dict, optional): counters of calls, fallbacks and timeouts to be
+            updated. Defaults to None.
+        max_tokens (int, optional): token budget. Defaults to LOCAL_MODEL_SETUPS["llm"]["max_tokens"].
+        timeout (float, optional): time budget in seconds.
+            Defaults to LOCAL_MODEL_SETUPS["llm"]["timeout"].
+
+    Returns:
+        str: summarized answer
+    """
+    if not prompt.endswith("?"):
+        prompt += "?"
+
+    start_t = time()
+    deadline = start_t + timeout
+    results = ""
+    tokens = 0
+    finish_reason = None
+    timed_out = False
+    for output in llm_model(
+        LOCAL_MODEL_SETUPS["llm"]["prompt_template"].format(
+            prompt=prompt, response=response
+        ),
+        max_tokens=max_tokens,
+        stop=["\n"],
+        grammar=load_grammar(),
+        stream=True,
+    ):
+        check_cancelled()
+        results += output["choices"][0]["text"]
+        tokens += 1
+        finish_reason = output["choices"][0]["finish_reason"]
+        if on_progress is not None and len(results.strip()) > 0:
+            on_progress(replace_substrings(results.strip(), ['"']))
+        if time() > deadline:
+            timed_out = True
+            break
+
+    duration = time() - start_t
+    metrics.record("summarization", duration, completion_tokens=tokens)
+    metrics.inc("llm_tokens", tokens, model="llm", kind="completion")
+    if duration > 0:
+        metrics.observe("llm_tokens_per_second", tokens / duration, model="llm")
+
+    results = replace_substrings(results.strip(), ['"'])
+    fallback = timed_out or finish_reason == "length" or len(results) == 0
+
+    if stats is not None:
+        stats["calls"] += 1
+        stats["fallbacks"] += int(fallback)
+        stats["timeouts"] += int(timed_out)
+
+    if fallback:
+        print(f"LLM summary is not completed within the budget, use: {response}")
+        return response
+
+    return results
+
+
+def plan_insight(prompt: str, data_and_model: dict) -> tuple:
+    """Answer a simple aggregate question directly with pandas (see plan_query),
+    and count the questions answered without the code model
+
+    Args:
+        prompt (str): user prompt
+        data_and_model (dict): loaded data and model
+
+    Returns:
+        tuple: pandas instruction and answer, (None, None) if the question is
+            left to the query engine
+    """
+    with metrics.span("query_planner"):
+        pandas_instruction_str = plan_query(prompt, data_and_model["data"])
+        response_text = None
+        if pandas_instruction_str is not None:
+            try:
+                # the planned instructions are built from the column names only
+                response_text = run_pandas_instruction(
+                    data_and_model["data"], pandas_instruction_str
+                )
+            except Exception as e:
+                print(f"Planned pandas instruction failed, query it instead: {e}")
+                pandas_instruction_str = None
+
+    hit = pandas_instruction_str is not None
+    data_and_model["planner_stats"]["hits"] += int(hit)
+    data_and_model["planner_stats"]["misses"] += int(not hit)
+    metrics.inc("query_planner", result="hit" if hit else "miss")
+    return pandas_instruction_str, response_text
+
 
-from process import DASHBOARD_STYLE, LOCAL_MODEL_SETUPS
-from process.utils import create_img, replace_substrings
+def _is_failed(response_text) -> bool:
+    """Check if the pandas instruction failed, see IsolatedInstructionParser"""
+    return str(response_text).startswith(INSTRUCTION_ERROR)
 
 
-def show_insight(tab, n_clicks, llm_flag, prompt, current_output, data_and_model):
+def query_insight(
+    llm_flag: str, prompt: str, data_and_model: dict, on_progress=None
+) -> dict:
+    """Answer a prompt with the query engine (and LLM)
 
-    if tab == "tab-data-insight":
-        if n_clicks > 0:
-            if prompt:
+    Args:
+        llm_flag (str): use_llm or not_use_llm
+        prompt (str): user prompt
+        data_and_model (dict): loaded data and model
+        on_progress (callable, optional): called with the partial answer
+            while the LLM is generating. Defaults to None.
+
+    Returns:
+        dict: answer with pandas_instruction_str, response, image_src and if
+            the instruction failed
+    """
+    pandas_instruction_str = None
+    if QUERY_PLANNER["enable"]:
+        pandas_instruction_str, response_text = plan_insight(prompt, data_and_model)
+
+    semantic_cache = data_and_model.get("semantic_cache")
+    if pandas_instruction_str is None and semantic_cache is not None:
+        with metrics.span("embedding"):
+            embedding = semantic_cache.embed(prompt)
+        terms = prompt_terms(prompt, data_and_model["data"].columns)
+        pandas_instruction_str = semantic_cache.get(embedding, terms)
+
+        if pandas_instruction_str is not None:
+            try:
+                response_text = None
+                if "plot" not in pandas_instruction_str.lower():
+                    with metrics.span("pandas_execution"):
+                        if data_and_model["executor"] is not None:
+                            response_text = data_and_model["executor"].run(
+                                pandas_instruction_str
+                            )
+                        else:
+                            response_text = run_pandas_instruction(
+                                data_and_model["data"], pandas_instruction_str
+                            )
+            except Exception as e:
+                print(f"Cached pandas instruction failed, query it again: {e}")
+                semantic_cache.remove(pandas_instruction_str)
+                pandas_instruction_str = None
+
+    if pandas_instruction_str is None:
+        with data_and_model["model_locks"]["code_model"]:
+            check_cancelled()
+            with metrics.span("query_engine"):
                 response = data_and_model["query_engine"].query(prompt)
-                pandas_instruction_str = response.metadata["pandas_instruction_str"]
-                # plot "PurifiedRCP/JuiceDM" and "R.DM.Sep", and their difference
-                if "plot" in pandas_instruction_str.lower():
-                    image_src = create_img(
-                        data_and_model["data"], pandas_instruction_str
-                    )
-
-                    return [
-                        html.Div(
-                            [
-                                current_output,
-                                html.P(
-                                    f"Q: {prompt}",
-                                    style=DASHBOARD_STYLE["prompt"]["style"],
-                                ),
-                                html.Div(
-                                    [html.Img(src=image_src)],
-                                    style=DASHBOARD_STYLE["image"]["style"],
-                                ),
-                            ]
-                        ),
-                        pandas_instruction_str,
-                    ]
-                else:
-                    if llm_flag == "use_llm":
-                        if not prompt.endswith("?"):
-                            prompt += "?"
-
-                        llm_tries = 0
-                        while True:
-                            results = data_and_model["llm_model"](
-                                LOCAL_MODEL_SETUPS["llm"]["prompt_template"].format(
-                                    prompt=prompt, response=response.response
-                                ),
-                                max_tokens=100,
-                                stop=["\\n", "\n", "."],
-                            )["choices"][0]["text"].strip()
-
-                            if len(results) > 0:
-                                results = replace_substrings(results, ['"'])
-                                break
-
-                            llm_tries += 1
-                            print(f"LLM trials: {llm_tries} ...")
-                            if llm_tries == 100:
-                                break
-
-                    elif llm_flag == "not_use_llm":
-                        results = response.response
-
-                    return [
-                        html.Div(
-                            [
-                                current_output,
-                                html.P(
-                                    f"Q: {prompt}",
-                                    style=DASHBOARD_STYLE["prompt"]["style"],
-                                ),
-                                html.Pre(
-                                    results,
-                                    style=DASHBOARD_STYLE["answer"]["style"],
-                                ),
-                            ]
-                        ),
-                        pandas_instruction_str,
-                    ]
+        # a cancelled generation is cut short, so it is not cached
+        check_cancelled()
+        # the raw output may be in a markdown block or indented
+        pandas_instruction_str = clean_instruction(
+            response.metadata["pandas_instruction_str"]
+        )
+        response_text = response.response
+        if semantic_cache is not None and not _is_failed(response_text):
+            semantic_cache.add(embedding, prompt, pandas_instruction_str, terms)
+
+    answer = {
+        "pandas_instruction_str": pandas_instruction_str,
+        "response": None,
+        "image_src": None,
+        # e.g., the executor timed out, so the answer is not cached
+        "failed": _is_failed(response_text),
+    }
+
+    # plot "PurifiedRCP/JuiceDM" and "R.DM.Sep", and their difference
+    if "plot" in pandas_instruction_str.lower():
+        with metrics.span("plot_rendering"):
+            if data_and_model["plot_service"] is not None:
+                answer["image_src"] = data_and_model["plot_service"].render(
+                    pandas_instruction_str
+                )
+            elif data_and_model["executor"] is not None:
+                answer["image_src"] = "data:image/png;base64," + b64encode(
+                    data_and_model["executor"].render(pandas_instruction_str)
+                ).decode("utf-8")
             else:
-                return [html.Div("Please enter a prompt."), None]
-        else:
-            return [None, None]
+                answer["image_src"] = create_img(
+                    data_and_model["data"], pandas_instruction_str
+                )
+    elif llm_flag == "use_llm":
+        with data_and_model["model_locks"]["llm_model"]:
+            check_cancelled()
+            answer["response"] = summarize_response(
+                prompt,
+                response_text,
+                data_and_model["llm_model"],
+                on_progress=on_progress,
+                stats=data_and_model["summary_stats"],
+            )
+    elif llm_flag == "not_use_llm":
+        answer["response"] = response_text
+
+    return answer
+
+
+def cached_query_insight(
+    llm_flag: str, prompt: str, data_and_model: dict, on_progress=None
+) -> dict:
+    """Answer a prompt, reusing the cached answer of the same prompt/data if possible
+
+    Args:
+        llm_flag (str): use_llm or not_use_llm
+        prompt (str): user prompt
+        data_and_model (dict): loaded data and model
+        on_progress (callable, optional): called with the partial answer
+            while the LLM is generating. Defaults to None.
+
+    Returns:
+        dict: answer with pandas_instruction_str, response and image_src
+    """
+    with metrics.trace("insight", prompt=prompt, llm_flag=llm_flag):
+        with metrics.span("insight"):
+            answer_cache = data_and_model.get("answer_cache")
+            if answer_cache is None:
+                return query_insight(llm_flag, prompt, data_and_model, on_progress)
+
+            data_version = data_and_model["data_version"]
+            answer = answer_cache.get(prompt, llm_flag, data_version)
+            if answer is None:
+                answer = query_insight(llm_flag, prompt, data_and_model, on_progress)
+                if not answer["failed"]:
+                    answer_cache.set(prompt, llm_flag, data_version, answer)
+
+            return answer
+
+
+def render_entry(prompt: str, answer: dict):
+    """Render a question and its answer
+
+    Args:
+        prompt (str): user prompt
+        answer (dict): answer with pandas_instruction_str, response and image_src
+
+    Returns:
+        Div: question and answer
+    """
+    if answer["image_src"] is not None:
+        answer_content = html.Div(
+            [html.Img(src=answer["image_src"])],
+            style=DASHBOARD_STYLE["image"]["style"],
+        )
     else:
-        return [None, None]
+        answer_content = html.Pre(
+            answer["response"],
+            style=DASHBOARD_STYLE["answer"]["style"],
+        )
+
+    return html.Div(
+        [
+            html.P(
+                f"Q: {prompt}",
+                style=DASHBOARD_STYLE["prompt"]["style"],
+            ),
+            answer_content,
+        ]
+    )
+
+
+def render_history(session_id: str, data_and_model: dict) -> list:
+    """Render the conversation of a session
+
+    Args:
+        session_id (str): session id
+        data_and_model (dict): loaded data and model
+
+    Returns:
+        list: questions and answers
+    """
+    return [
+        render_entry(entry["prompt"], entry["answer"])
+        for entry in data_and_model["history"].get(session_id)
+    ]
+
+
+def append_answer(
+    prompt: str, answer: dict, session_id: str, data_and_model: dict, pending=False
+) -> list:
+    """Append the question and answer to the conversation, only the new entry
+    is sent to the page
+
+    Args:
+        prompt (str): user prompt
+        answer (dict): answer with pandas_instruction_str, response and image_src
+        session_id (str): session id
+        data_and_model (dict): loaded data and model
+        pending (bool, optional): if the last entry on the page is a partial
+            answer to be replaced. Defaults to False.
+
+    Returns:
+        list: the conversation update and the pandas instruction
+    """
+    output = Patch()
+    if pending:
+        del output[-1]
+    output.append(render_entry(prompt, answer))
+
+    if data_and_model["history"].append(
+        session_id, {"prompt": prompt, "answer": answer}
+    ):
+        del output[0]
+
+    return [output, answer["pandas_instruction_str"]]
+
+
+def _check_insight_request(llm_flag, prompt, data_and_model):
+    """Check if a prompt can be answered
+
+    Returns:
+        str: the message to be shown if it cannot be answered, otherwise None
+    """
+    if not prompt:
+        return "Please enter a prompt."
+
+    required_components = ["query_engine"]
+    if llm_flag == "use_llm":
+        required_components.append("llm_model")
+    if not is_ready(data_and_model, *required_components):
+        return "Models are warming up, please try again shortly."
+
+    return None
+
+
+def show_insight(tab, n_clicks, llm_flag, prompt, session_id, data_and_model):
+    if tab != "tab-data-insight":
+        return [[], None]
+
+    if n_clicks <= 0:
+        return [render_history(session_id, data_and_model), None]
+
+    message = _check_insight_request(llm_flag, prompt, data_and_model)
+    if message is not None:
+        return [no_update, message]
+
+    with hold_dataset(data_and_model):
+        answer = cached_query_insight(llm_flag, prompt, data_and_model)
+    return append_answer(prompt, answer, session_id, data_and_model)
+
+
+def submit_insight(
+    tab, n_clicks, llm_flag, prompt, session_id, data_and_model, job=None
+):
+    """Submit a prompt to the job queue, the answer is collected by poll_insight
+
+    Returns:
+        list: conversation update, pandas instruction (job status), job and if polling is disabled
+    """
+    if tab != "tab-data-insight" or n_clicks <= 0:
+        # the job being answered is still polled across the tabs, but the page
+        # no longer shows its partial answer
+        if job is not None:
+            job = dict(job, streaming=False)
+        return show_insight(
+            tab, n_clicks, llm_flag, prompt, session_id, data_and_model
+        ) + [job, job is None]
+
+    message = _check_insight_request(llm_flag, prompt, data_and_model)
+    if message is not None:
+        return [no_update, message, None, True]
+
+    # the data of the job is kept until it is finished, even if it is reloaded
+    users = data_and_model.get("users")
+    if users is not None:
+        users.acquire()
+    job_id = data_and_model["job_queue"].submit(
+        cached_query_insight,
+        llm_flag,
+        prompt,
+        data_and_model,
+        session_id=session_id,
+        report_progress=True,
+        on_finish=users.release if users is not None else None,
+    )
+    if job_id is None:
+        return [no_update, "The server is busy, please try again shortly.", None, True]
+
+    return [
+        no_update,
+        f"Question is queued: {prompt}",
+        {"id": job_id, "prompt": prompt},
+        False,
+    ]
+
+
+def poll_insight(job, session_id, data_and_model, tab="tab-data-insight"):
+    """Check the submitted job, and show the answer when it is done. On the
+    other tabs the answer is only added to the conversation, which is shown
+    when the insight tab is selected again.
+
+    Returns:
+        list: conversation update, pandas instruction (job status), job and if polling is disabled
+    """
+    if job is None:
+        return [no_update, None, None, True]
+
+    # the partial answer shown by the last poll is replaced
+    output = Patch() if tab == "tab-data-insight" else no_update
+    if job.get("streaming") and output is not no_update:
+        del output[-1]
+
+    job_queue = data_and_model["job_queue"]
+    job_status = job_queue.get(job["id"])
+
+    if job_status is None:
+        return [output, "The question is lost, please submit again.", None, True]
+
+    if job_status["status"] in ["queued", "running"]:
+        job_message = f"Question is {job_status['status']}: {job['prompt']}"
+        if job_status["progress"] is not None and output is not no_update:
+            output.append(
+                render_entry(
+                    job["prompt"],
+                    {"response": job_status["progress"], "image_src": None},
+                )
+            )
+            return [output, job_message, dict(job, streaming=True), False]
+
+        return [no_update, job_message, job, False]
+
+    job_queue.pop(job["id"])
+
+    if job_status["status"] == "cancelled":
+        return [output, "The question has been cancelled.", None, True]
+
+    if job_status["status"] == "failed":
+        return [
+            output,
+            f"Not able to answer the question: {job_status['error']}",
+            None,
+            True,
+        ]
+
+    if output is no_update:
+        data_and_model["history"].append(
+            session_id, {"prompt": job["prompt"], "answer": job_status["result"]}
+        )
+        return [no_update, job_status["result"]["pandas_instruction_str"], None, True]
+
+    return append_answer(
+        job["prompt"],
+        job_status["result"],
+        session_id,
+        data_and_model,
+        pending=job.get("streaming", False),
+    ) + [None, True]
@@ -1,24 +1,208 @@
+from collections import OrderedDict
+from threading import Lock
+
 import dash_html_components as html
 from dash_table import DataTable
+from pandas import DataFrame
+
+from process import DASHBOARD_STYLE, DATA_TABLE
+from process.metrics import metrics
+from process.wrapper import is_ready
+
+FILTER_OPERATORS = [
+    ["ge ", ">="],
+    ["le ", "<="],
+    ["lt ", "<"],
+    ["gt ", ">"],
+    ["ne ", "!="],
+    ["eq ", "="],
+    ["contains "],
+    ["datestartswith "],
+]
+
+table_views = OrderedDict()
+table_views_lock = Lock()
+
+
+def split_filter_part(filter_part: str) -> tuple:
+    """Split a DataTable filter, e.g., {R.DM.Sep} > 0.5
+
+    Args:
+        filter_part (str): one filter of the DataTable filter query
+
+    Returns:
+        tuple: column name, operator and value
+    """
+    # the column is taken first, so its name may contain an operator
+    start = filter_part.find("{")
+    end = filter_part.find("}", start + 1)
+    if start < 0 or end < 0:
+        return None, None, None
+    name = filter_part[start + 1 : end]
+    rest = filter_part[end + 1 :].lstrip()
+
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            # s (case-sensitive) and i (case-insensitive) operators, e.g., scontains
+            prefix = next(
+                (p for p in ["", "s", "i"] if rest.startswith(p + operator)), None
+            )
+            if prefix is None:
+                continue
+
+            value_part = rest[len(prefix + operator) :].strip()
+            if value_part == "":
+                return None, None, None
+            v0 = value_part[0]
+            if len(value_part) > 1 and v0 == value_part[-1] and v0 in ("'", '"', "`"):
+                value = value_part[1:-1].replace("\\" + v0, v0)
+            else:
+                try:
+                    value = float(value_part)
+                except ValueError:
+                    value = value_part
+
+            return name, operator_type[0].strip(), value
+
+    return None, None, None
+
+
+def filter_and_sort_data(df: DataFrame, filter_query: str, sort_by: tuple) -> DataFrame:
+    """Filter and sort the data as requested by the DataTable
+
+    Args:
+        df (DataFrame): data to be shown
+        filter_query (str): DataTable filter query
+        sort_by (tuple): (column, direction) to sort by
+
+    Returns:
+        DataFrame: filtered and sorted data
+    """
+    columns = {str(col): col for col in df.columns}
+
+    for filter_part in (filter_query or "").split(" && "):
+        col, operator, value = split_filter_part(filter_part)
+        if col not in columns:
+            continue
+
+        col_data = df[columns[col]]
+        try:
+            if operator == "contains":
+                mask = col_data.astype(str).str.contains(str(value), regex=False)
+            elif operator == "datestartswith":
+                mask = col_data.astype(str).str.startswith(str(value))
+            else:
+                mask = getattr(col_data, operator)(value)
+        except TypeError:
+            # e.g., compare text with a number
+            return df.iloc[0:0]
+        df = df[mask]
 
-from process import DASHBOARD_STYLE
+    sort_by = [
+        (columns[col], direction) for col, direction in sort_by if col in columns
+    ]
+    if len(sort_by) > 0:
+        df = df.sort_values(
+            [col for col, _ in sort_by],
+            ascending=[direction == "asc" for _, direction in sort_by],
+            kind="stable",
+        )
+
+    return df
+
+
+def get_table_view(
+    data_and_model: dict,
+    filter_query: str,
+    sort_by: list,
+    view_size: int = DATA_TABLE["view_size"],
+) -> DataFrame:
+    """Get the filtered and sorted data, the recent views are kept on the server
+
+    Args:
+        data_and_model (dict): loaded data and model
+        filter_query (str): DataTable filter query
+        sort_by (list): DataTable sort_by
+        view_size (int, optional): number of views to be kept. Defaults to DATA_TABLE["view_size"].
+
+    Returns:
+        DataFrame: filtered and sorted data
+    """
+    sort_by = tuple(
+        (sort_col["column_id"], sort_col["direction"]) for sort_col in sort_by or []
+    )
+    key = (data_and_model["data_version"], filter_query or "", sort_by)
+
+    with table_views_lock:
+        if key in table_views:
+            table_views.move_to_end(key)
+            return table_views[key]
+
+    view = filter_and_sort_data(data_and_model["data"], filter_query, sort_by)
+
+    with table_views_lock:
+        table_views[key] = view
+        while len(table_views) > view_size:
+            table_views.popitem(last=False)
+
+    return view
+
+
+def expire_table_views(data_version: str):
+    """Remove the views of an old data version, e.g., the data has been reloaded
+
+    Args:
+        data_version (str): fingerprint of the old data
+    """
+    with table_views_lock:
+        for key in [key for key in table_views if key[0] == data_version]:
+            table_views.pop(key)
+
+
+def update_table(page_current, page_size, filter_query, sort_by, data_and_model):
+    """Get the page of data shown in the DataTable
+
+    Returns:
+        list: data of the page and the number of pages
+    """
+    with metrics.span("update_table"):
+        view = get_table_view(data_and_model, filter_query, sort_by)
+        page_count = max(1, -(-len(view) // page_size))
+        page = view.iloc[page_current * page_size : (page_current + 1) * page_size]
+        return [page.to_dict("records"), page_count]
 
 
 def render_table(tab, data_and_model):
     if tab == "tab-data":
-        return html.Div(
-            [
-                DataTable(
-                    id="table",
-                    columns=[
-                        {"name": i, "id": i} for i in data_and_model["data"].columns
-                    ],
-                    data=data_and_model["data"].to_dict("records"),
-                    filter_action="native",
-                    fill_width=False,
-                    style_data=DASHBOARD_STYLE["data"]["style"]["cell"],
-                    style_header=DASHBOARD_STYLE["data"]["style"]["header"],
-                    style_table=DASHBOARD_STYLE["data"]["style"]["table"],
-                ),
-            ]
-        )
+        if not is_ready(data_and_model, "data"):
+            return html.Div("Data is warming up, please try again shortly.")
+
+        with metrics.span("render_table"):
+            data, page_count = update_table(
+                0, DATA_TABLE["page_size"], "", [], data_and_model
+            )
+            return html.Div(
+                [
+                    DataTable(
+                        id="table",
+                        columns=[
+                            {"name": str(i), "id": str(i)}
+                            for i in data_and_model["data"].columns
+                        ],
+                        data=data,
+                        page_current=0,
+                        page_size=DATA_TABLE["page_size"],
+                        page_count=page_count,
+                        page_action="custom",
+                        filter_action="custom",
+                        filter_query="",
+                        sort_action="custom",
+                        sort_mode="multi",
+                        sort_by=[],
+                        fill_width=False,
+                        style_data=DASHBOARD_STYLE["data"]["style"]["cell"],
+                        style_header=DASHBOARD_STYLE["data"]["style"]["header"],
+                        style_table=DASHBOARD_STYLE["data"]["style"]["table"],
+                    ),
+                ]
+            )
@@ -1,12 +1,18 @@
+from ast import Module, parse, unparse
 from base64 import b64encode
 from io import BytesIO
 
+import numpy as np
+import pandas as pd
+from llama_index.experimental.exec_utils import safe_eval, safe_exec
 from matplotlib.pyplot import close as plt_close
 from pandas import DataFrame
 
 
-def create_img(df: DataFrame, pandas_instruction_str: str, verbose: bool = True) -> str:
-    """Create image and show it on the dashboard
+def render_img(
+    df: DataFrame, pandas_instruction_str: str, verbose: bool = True
+) -> bytes:
+    """Render the image of a plotting instruction
 
     Args:
         df (DataFrame): input dataframe
@@ -14,7 +20,7 @@ def create_img(df: DataFrame, pandas_instruction_str: str, verbose: bool = True)
         verbose (bool, optional): debug flag. Defaults to True.
 
     Returns:
-        str: saved data codes
+        bytes: image in PNG
     """
     if verbose:
         print(pandas_instruction_str)
@@ -24,7 +30,21 @@ def create_img(df: DataFrame, pandas_instruction_str: str, verbose: bool = True)
     output_buffer = BytesIO()
     fig.figure.savefig(output_buffer, format="png")  # Access the figure object
     plt_close(fig.figure)
-    image_data = output_buffer.getvalue()
+    return output_buffer.getvalue()
+
+
+def create_img(df: DataFrame, pandas_instruction_str: str, verbose: bool = True) -> str:
+    """Create image and show it on the dashboard
+
+    Args:
+        df (DataFrame): input dataframe
+        pandas_instruction_str (str): Pandas instrudction
+        verbose (bool, optional): debug flag. Defaults to True.
+
+    Returns:
+        str: saved data codes
+    """
+    image_data = render_img(df, pandas_instruction_str, verbose=verbose)
 
     # Convert the image_data to base64
     image_base64 = b64encode(image_data).decode("utf-8")
@@ -33,6 +53,29 @@ def create_img(df: DataFrame, pandas_instruction_str: str, verbose: bool = True)
     return f"data:image/png;base64,{image_base64}"
 
 
+def run_pandas_instruction(df: DataFrame, pandas_instruction_str: str) -> str:
+    """Run a pandas instruction in the same way as PandasQueryEngine,
+    but raise the error instead of returning it as the answer
+
+    Args:
+        df (DataFrame): input dataframe
+        pandas_instruction_str (str): Pandas instruction
+
+    Returns:
+        str: the output of the last line of the instruction
+    """
+    local_vars = {"df": df, "pd": pd}
+    global_vars = {"np": np}
+
+    tree = parse(pandas_instruction_str)
+    safe_exec(unparse(Module(tree.body[:-1], type_ignores=[])), {}, local_vars)
+    return str(
+        safe_eval(
+            unparse(Module(tree.body[-1:], type_ignores=[])), global_vars, local_vars
+        )
+    )
+
+
 def replace_substrings(string, substrings):
     """Removes all occurrences of specified substrings from the given string.
 
@@ -0,0 +1,149 @@
+from os import POSIX_FADV_WILLNEED, posix_fadvise
+from os.path import exists
+from time import time
+
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from process import LOCAL_MODEL_SETUPS, MODEL_ROUTING, WARM_UP
+from process.metrics import metrics
+from process.model import RoutedQueryEngine
+from process.runtime import get_runtime_profile
+from process.utils import create_img
+
+# a question every data can answer, the answer is not kept in the caches
+WARM_UP_QUESTION = "How many rows are there"
+
+
+def touch_weights(model_path: str, chunk_size: int = 64 * 1024**2) -> int:
+    """Read the model weights into the page cache, so the llama.cpp memory map
+    does not have to fault the pages in from the disk on the first questions
+
+    Args:
+        model_path (str): GGUF model path
+        chunk_size (int, optional): bytes read at once. Defaults to 64 MiB.
+
+    Returns:
+        int: bytes read, 0 if the model file is not found
+    """
+    if not exists(model_path):
+        return 0
+
+    size = 0
+    buffer = bytearray(chunk_size)
+    with open(model_path, "rb", buffering=0) as fid:
+        posix_fadvise(fid.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+        while True:
+            read_size = fid.readinto(buffer)
+            if read_size == 0:
+                break
+            size += read_size
+    return size
+
+
+def _plot_instruction(df) -> str:
+    """Get a plotting instruction of the data, None if it has no numeric columns"""
+    columns = [
+        col
+        for col in df.columns
+        if is_numeric_dtype(df[col]) and not is_bool_dtype(df[col])
+    ]
+    if len(columns) == 0:
+        return None
+    if len(columns) == 1:
+        return f"df[{columns[0]!r}].plot()"
+    return f"df.plot(x={columns[0]!r}, y={columns[1]!r}, kind='scatter')"
+
+
+def warm_up(
+    data_and_model: dict,
+    weights: str = WARM_UP["weights"],
+    max_tokens: int = WARM_UP["max_tokens"],
+    plot: bool = WARM_UP["plot"],
+) -> dict:
+    """Warm up the loaded data and model before serving, as the first questions
+    are slow otherwise: the weights of the local models are read into the page
+    cache, the code model(s) and the LLM answer a canned question, and a plot is
+    rendered in this process and by the plot service
+
+    Args:
+        data_and_model (dict): loaded data and model
+        weights (str, optional): "touch" to read the weights into the page cache,
+            "mlock" if they are locked in memory at loading (see get_runtime_profile)
+            or None. Defaults to WARM_UP["weights"].
+        max_tokens (int, optional): token budget of the LLM. Defaults to WARM_UP["max_tokens"].
+        plot (bool, optional): if a plot is rendered. Defaults to WARM_UP["plot"].
+
+    Returns:
+        dict: seconds of each warm-up step
+    """
+    from process.style.show_insight import summarize_response
+
+    timings = {}
+
+    def _step(step: str, func):
+        start_t = time()
+        try:
+            func()
+        except Exception as e:
+            print(f"Warm-up step {step} failed: {e}")
+        timings[step] = time() - start_t
+        metrics.record(f"warm_up_{step}", timings[step])
+
+    models = ["code_model", "llm"]
+    if MODEL_ROUTING["enable"]:
+        models.append("small_code_model")
+
+    if weights == "touch" and not data_and_model.get("remote", False):
+        for model in models:
+            runtime_profile = get_runtime_profile(model)
+            # the weights read at loading (no mmap) or locked in memory are resident
+            use_mmap = runtime_profile.get("use_mmap", True)
+            if use_mmap and not runtime_profile.get("use_mlock", False):
+                _step(
+                    f"touch_{model}",
+                    lambda: touch_weights(LOCAL_MODEL_SETUPS[model]["path"]),
+                )
+
+    query_engine = data_and_model["query_engine"]
+    query_engines = {"code_model": query_engine}
+    if isinstance(query_engine, RoutedQueryEngine):
+        query_engines = {
+            "small_code_model": query_engine.small_query_engine,
+            "code_model": query_engine.query_engine,
+        }
+
+    answer = str(len(data_and_model["data"]))
+    for model, engine in query_engines.items():
+        with data_and_model["model_locks"]["code_model"]:
+            _step(f"generate_{model}", lambda: engine.query(WARM_UP_QUESTION))
+
+    with data_and_model["model_locks"]["llm_model"]:
+        _step(
+            "generate_llm",
+            lambda: summarize_response(
+                WARM_UP_QUESTION,
+                answer,
+                data_and_model["llm_model"],
+                max_tokens=max_tokens,
+            ),
+        )
+
+    pandas_instruction_str = _plot_instruction(data_and_model["data"])
+    if plot and pandas_instruction_str is not None:
+        _step(
+            "plot",
+            lambda: create_img(
+                data_and_model["data"], pandas_instruction_str, verbose=False
+            ),
+        )
+        if data_and_model["plot_service"] is not None:
+            _step(
+                "plot_service",
+                lambda: data_and_model["plot_service"].render(pandas_instruction_str),
+            )
+
+    print(
+        f"Warm-up is done in {sum(timings.values()):.1f} seconds: "
+        + ", ".join(f"{step} {seconds:.1f}s" for step, seconds in timings.items())
+    )
+    return timings
@@ -0,0 +1,117 @@
+from os import stat
+from threading import Thread
+from time import sleep
+
+from process import DATA_RELOAD, DATASETS
+from process.registry import release_dataset
+from process.wrapper import is_ready, reload_data
+
+
+class DataWatcher:
+    """Poll the workbooks of the datasets and reload the changed ones in the
+    background, without restarting the dashboard or reloading the models.
+
+    A workbook is read again once its modification time and size have been
+    the same for two polls, so a file being written is not read. The default
+    dataset is swapped in place (see reload_data), the others are removed from
+    the dataset registry and loaded again on their next use.
+    """
+
+    def __init__(
+        self,
+        data_and_model: dict,
+        interval: float = DATA_RELOAD["interval"],
+        grace_time: float = DATA_RELOAD["grace_time"],
+    ):
+        """Initialize the data watcher
+
+        Args:
+            data_and_model (dict): loaded data and model
+            interval (float, optional): seconds between polls. Defaults to DATA_RELOAD["interval"].
+            grace_time (float, optional): maximum seconds to keep the old data for
+                the requests in flight. Defaults to DATA_RELOAD["grace_time"].
+        """
+        self.data_and_model = data_and_model
+        self.interval = interval
+        self.grace_time = grace_time
+        self.signatures = {
+            dataset["path"]: self._signature(dataset["path"])
+            for dataset in DATASETS.values()
+        }
+        self.pending = {}
+        self.reloads = 0
+        self.thread = Thread(target=self._watch, daemon=True)
+
+    def start(self):
+        """Start polling in a background thread
+
+        Returns:
+            DataWatcher: the watcher itself
+        """
+        self.thread.start()
+        return self
+
+    @staticmethod
+    def _signature(data_path: str):
+        try:
+            data_stat = stat(data_path)
+        except OSError:
+            return None
+        return (data_stat.st_mtime_ns, data_stat.st_size)
+
+    def _watch(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Not able to check the data: {e}")
+
+    def check(self):
+        """Reload the datasets of the workbooks which have changed since the last check"""
+        for data_path in list(self.signatures):
+            signature = self._signature(data_path)
+            if signature is None or signature == self.signatures[data_path]:
+                self.pending.pop(data_path, None)
+                continue
+
+            # wait for one more poll in case the file is still being written
+            if self.pending.get(data_path) != signature:
+                self.pending[data_path] = signature
+                continue
+
+            if self._reload(data_path):
+                self.pending.pop(data_path)
+                self.signatures[data_path] = signature
+
+    def _reload(self, data_path: str) -> bool:
+        """Reload the datasets of a workbook
+
+        Returns:
+            bool: if it is done, False if the default dataset is still being loaded
+        """
+        data_and_model = self.data_and_model
+        for name, dataset in DATASETS.items():
+            if dataset["path"] != data_path:
+                continue
+
+            if name != data_and_model["dataset"]:
+                removed_dataset = data_and_model["datasets"].remove(name)
+                if removed_dataset is not None:
+                    release_dataset(removed_dataset, self.grace_time)
+                continue
+
+            if not is_ready(data_and_model, "query_engine"):
+                return False
+
+            print(f"{data_path} has changed, reloading {name} ...")
+            try:
+                if reload_data(data_and_model, self.grace_time):
+                    self.reloads += 1
+                data_and_model["status"]["data"]["error"] = None
+            except Exception as e:
+                # the current data is kept
+                data_and_model["status"]["data"]["error"] = str(e)
+                print(f"Not able to reload {name}, keep the current data: {e}")
+
+        return True
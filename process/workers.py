@@ -0,0 +1,80 @@
+# entry points of the worker processes of IsolatedExecutor and PlotService, the
+# workers are started with spawn and import this module, so only the standard
+# library is imported here and the rest when a worker starts
+from math import ceil
+
+plot_data = None
+
+
+def executor_worker_main(
+    conn, data_path: str, cpu_time: int, columns, index=None, objects: dict = None
+):
+    """Run the generated code sent through the pipe until None is received
+
+    Args:
+        conn (Connection): pipe to the executor
+        data_path (str): Arrow file of the data, its columns are named by position
+        cpu_time (int): CPU time limit in seconds of each code
+        columns (Index): column labels of the data
+        index (Index, optional): index of the data, None for a range index. Defaults to None.
+        objects (dict, optional): the columns not in the Arrow file by position.
+            Defaults to None.
+    """
+    from resource import RLIMIT_CPU, RUSAGE_SELF, getrlimit, getrusage, setrlimit
+
+    from matplotlib import use
+    from pandas import DataFrame, RangeIndex
+    from pyarrow.feather import read_table
+
+    from process.utils import render_img, run_pandas_instruction
+
+    use("Agg")
+    # one block per column, so the numeric columns stay views of the memory map
+    df = read_table(data_path, memory_map=True).to_pandas(split_blocks=True)
+    for position, values in sorted((objects or {}).items()):
+        if df.shape[1] == 0:
+            df = DataFrame(index=RangeIndex(len(values)))
+        df.insert(position, str(position), values)
+    df.columns = columns
+    if index is not None:
+        df.index = index
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        task_type, pandas_instruction_str = task
+
+        # the process is killed by SIGXCPU when the limit is exceeded
+        usage = getrusage(RUSAGE_SELF)
+        setrlimit(
+            RLIMIT_CPU,
+            (
+                ceil(usage.ru_utime + usage.ru_stime) + cpu_time,
+                getrlimit(RLIMIT_CPU)[1],
+            ),
+        )
+
+        try:
+            if task_type == "plot":
+                result = render_img(df, pandas_instruction_str, verbose=False)
+            else:
+                result = run_pandas_instruction(df, pandas_instruction_str)
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def init_plot_worker(df):
+    global plot_data
+
+    from matplotlib import use
+
+    use("Agg")
+    plot_data = df
+
+
+def render_plot(pandas_instruction_str: str) -> bytes:
+    from process.utils import render_img
+
+    return render_img(plot_data, pandas_instruction_str)
@@ -1,20 +1,303 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from os.path import join
+from threading import Lock
+from time import time
 from typing import Literal
 
-from process.data import read_data
+from pandas import DataFrame
+
+from process import (
+    ANSWER_CACHE,
+    CODE_EXECUTOR,
+    DATA_RELOAD,
+    DATASET_REGISTRY,
+    INFERENCE_SERVER,
+    JOB_QUEUE,
+    MODEL_LOADING,
+    MODEL_ROUTING,
+    PLOT_SERVICE,
+    PROMPT_CONTEXT,
+    SEMANTIC_CACHE,
+    WARM_UP,
+)
+from process.cache import AnswerCache, SemanticCache
+from process.data import data_fingerprint, read_data, validate_data
+from process.executor import IsolatedExecutor
+from process.history import ConversationHistory
+from process.jobs import JobQueue
+from process.metrics import metrics
 from process.model import (
+    RoutedQueryEngine,
     create_dataframe_engine,
     load_code_model_local,
     load_embedding_model_local,
     load_llm_model_local,
     load_service,
+    load_small_code_model_local,
+    prime_prompt_cache,
+    register_llm_metrics,
 )
+from process.plot import PlotService
+from process.registry import DatasetRegistry, DatasetUsers, release_dataset
+from process.schema import SchemaContext
+from process.server import load_code_model_remote, load_llm_model_remote
+from process.warmup import warm_up
+
+
+def is_ready(data_and_model: dict, *components: str) -> bool:
+    """Check if the components of data and model have been loaded
+
+    Args:
+        data_and_model (dict): loaded data and model
+        components (str): components to check, e.g., query_engine, llm_model
+
+    Returns:
+        bool: if all the components are ready
+    """
+    return all(
+        data_and_model["status"].get(component, {}).get("ready", False)
+        for component in components
+    )
+
+
+def _load_component(data_and_model: dict, component: str, loader):
+    """Load one component and record its readiness and loading time
+
+    Args:
+        data_and_model (dict): data and model to be updated
+        component (str): component name, e.g., data
+        loader (callable): function to load the component
+    """
+    status = data_and_model["status"][component]
+    start_t = time()
+    try:
+        data_and_model[component] = loader()
+    except Exception as e:
+        status["error"] = str(e)
+        print(f"Not able to load {component}: {e}")
+        raise
+    status["load_time"] = time() - start_t
+    metrics.record(f"load_{component}", status["load_time"])
+    status["ready"] = True
+    print(f"{component} is loaded in {status['load_time']:.1f} seconds ...")
+
+
+def _read_dataset(dataset: dict, name: str):
+    """Read the data of a dataset and start its executor and plot service
+
+    Args:
+        dataset (dict): dataset (or data and model) to be updated
+        name (str): dataset name, see DATASETS
+
+    Returns:
+        DataFrame: data
+    """
+    df = read_data(name)
+    _start_dataset_services(dataset, name, df)
+    return df
+
+
+def _start_dataset_services(dataset: dict, name: str, df: DataFrame, keep_images=()):
+    """Start the executor and plot service of the data of a dataset
+
+    Args:
+        dataset (dict): dataset (or data and model) to be updated
+        name (str): dataset name, see DATASETS
+        df (DataFrame): data
+        keep_images (set, optional): URLs of the images of the older data still
+            shown in the conversations. Defaults to ().
+    """
+    dataset["data_version"] = data_fingerprint(df)
+    # the requests holding the services, see hold_dataset
+    dataset["users"] = DatasetUsers()
+    dataset["executor"] = dataset["plot_service"] = None
+    if CODE_EXECUTOR["enable"]:
+        try:
+            dataset["executor"] = IsolatedExecutor(df)
+        except Exception as e:
+            # the generated code is run in this process instead
+            print(f"Not able to start the code executor of {name}: {e}")
+    if PLOT_SERVICE["enable"]:
+        dataset["plot_service"] = PlotService(
+            df,
+            dataset["data_version"],
+            plot_dir=join(PLOT_SERVICE["dir"], name),
+            plot_url=f"{PLOT_SERVICE['url']}{name}/",
+            executor=dataset["executor"],
+            keep_images=keep_images,
+        )
+
+
+def _create_dataset_engine(data_and_model: dict, dataset: dict):
+    """Create the query engine of a dataset, and prime the prompt cache with it
+
+    Args:
+        data_and_model (dict): loaded models
+        dataset (dict): dataset with data and executor
+
+    Returns:
+        PandasQueryEngine: query engine, RoutedQueryEngine if the small code model is loaded
+    """
+    # the schema summary is computed once for the data version
+    schema_context = None
+    if PROMPT_CONTEXT["enable"]:
+        with metrics.span("schema_context"):
+            schema_context = SchemaContext(
+                dataset["data"], embed_model=data_and_model["embed_model"]
+            )
+
+    query_engine = create_dataframe_engine(
+        dataset["data"], executor=dataset["executor"], schema_context=schema_context
+    )
+    small_code_model = data_and_model.get("small_code_model")
+    if small_code_model is not None:
+        small_query_engine = create_dataframe_engine(
+            dataset["data"],
+            executor=dataset["executor"],
+            llm=small_code_model,
+            schema_context=schema_context,
+        )
+
+    with data_and_model["model_locks"]["code_model"]:
+        with metrics.span("prime_prompt_cache"):
+            prime_prompt_cache(data_and_model["code_model"], query_engine)
+            if small_code_model is not None:
+                prime_prompt_cache(small_code_model, small_query_engine)
+
+    if small_code_model is not None:
+        return RoutedQueryEngine(small_query_engine, query_engine)
+    return query_engine
+
+
+def select_dataset(data_and_model: dict, name: str = None) -> dict:
+    """Get the data and model of a dataset. The default dataset is loaded with
+    the models, the others are loaded on first use by data_and_model["datasets"],
+    so check the readiness (is_ready) before using the data or query engine.
 
+    The data and model of a request should be selected once, the data can be
+    swapped by reload_data() in the meantime.
 
-def load_data_and_model(model_type: Literal["llama", "openai"] = "llama") -> dict:
+    Args:
+        data_and_model (dict): loaded data and model
+        name (str, optional): dataset name, see DATASETS. Defaults to None (the default dataset).
+
+    Returns:
+        dict: data and model of the dataset
+    """
+    if name is None or name == data_and_model["dataset"]:
+        # a copy, so a request keeps the data it started with if the data is reloaded
+        return dict(data_and_model)
+
+    dataset = data_and_model["datasets"].get(name)
+    return {
+        **data_and_model,
+        "data": None,
+        "data_version": None,
+        "query_engine": None,
+        "executor": None,
+        "plot_service": None,
+        "semantic_cache": None,
+        **dataset,
+        "dataset": name,
+        "status": dict(data_and_model["status"], **dataset["status"]),
+    }
+
+
+def reload_data(
+    data_and_model: dict, grace_time: float = DATA_RELOAD["grace_time"]
+) -> bool:
+    """Read the default dataset again, and swap the data, its executor, plot
+    service and query engine in data_and_model. The caches of the old data are
+    removed, and its worker processes are stopped when the requests in flight
+    (see select_dataset and hold_dataset) are done with the old data, or after
+    the grace time at the latest.
+
+    Args:
+        data_and_model (dict): loaded data and model
+        grace_time (float, optional): maximum seconds to keep the old data.
+            Defaults to DATA_RELOAD["grace_time"].
+
+    Returns:
+        bool: if the data has changed and been swapped
+    """
+    start_t = time()
+    name = data_and_model["dataset"]
+    df = read_data(name)
+    validate_data(df)
+    if data_fingerprint(df) == data_and_model["data_version"]:
+        return False
+
+    dataset = {"name": name, "data": df, "executor": None, "plot_service": None}
+    try:
+        # the images of the old data are kept while the conversations show them,
+        # they are removed by a later reload
+        _start_dataset_services(
+            dataset, name, df, data_and_model["history"].image_sources()
+        )
+        dataset["query_engine"] = _create_dataset_engine(data_and_model, dataset)
+    except Exception:
+        release_dataset(dataset)
+        raise
+
+    if SEMANTIC_CACHE["enable"] and list(map(str, df.columns)) != list(
+        map(str, data_and_model["data"].columns)
+    ):
+        # the cached instructions may use the columns which have gone
+        dataset["semantic_cache"] = SemanticCache(data_and_model["embed_model"])
+
+    old_dataset = {
+        "name": name,
+        "executor": data_and_model["executor"],
+        "plot_service": data_and_model["plot_service"],
+        "users": data_and_model.get("users"),
+    }
+    old_data_version = data_and_model["data_version"]
+    dataset.pop("name")
+    # one update, so a copy of data_and_model has either the old or the new data
+    data_and_model.update(dataset)
+
+    if data_and_model["answer_cache"] is not None:
+        data_and_model["answer_cache"].expire(old_data_version)
+
+    from process.style.show_table import expire_table_views
+
+    expire_table_views(old_data_version)
+    release_dataset(old_dataset, grace_time)
+
+    metrics.record("reload_data", time() - start_t)
+    print(f"Data is reloaded in {time() - start_t:.1f} seconds ...")
+    return True
+
+
+def load_data_and_model(
+    model_type: Literal["llama", "openai"] = "llama",
+    background: bool = MODEL_LOADING["background"],
+    workers: int = MODEL_LOADING["workers"],
+    warm_start: bool = WARM_UP["enable"],
+    remote: bool = INFERENCE_SERVER["enable"],
+) -> dict:
     """Load data and model
 
+    Data and models are loaded in parallel on a thread pool. The readiness and
+    loading time of each component are recorded in data_and_model["status"].
+    Only the default dataset (DATASET_REGISTRY["default"]) is loaded here, use
+    select_dataset() for the others. The llama models are not safe for concurrent use, so they must be used
+    with data_and_model["model_locks"]. With remote, the code
+    model and LLM are clients of the inference server (see cli/cli_server.py),
+    which queues the requests itself, so the locks are not taken. With warm_start,
+    the models and plotting are warmed up after loading (see warm_up), and the
+    warm_up component is ready when it is done.
+
     Args:
         model_type (Literal[&quot;llama&quot;, &quot;openai&quot;]): Model type in [LLAMA, OpenAI]
+        background (bool, optional): if return immediately and keep loading in the
+            background, use is_ready() before using a component.
+            Defaults to MODEL_LOADING["background"].
+        workers (int, optional): number of loading threads. Defaults to MODEL_LOADING["workers"].
+        warm_start (bool, optional): if warm up before serving. Defaults to WARM_UP["enable"].
+        remote (bool, optional): if the models are served by the inference server.
+            Defaults to INFERENCE_SERVER["enable"].
 
     Raises:
         ValueError: Invalid model type
@@ -28,15 +311,107 @@ def load_data_and_model(model_type: Literal["llama", "openai"] = "llama") -> dic
             f"Invalid model_type: {model_type}. Must be 'llama' or 'openai'."
         )
 
-    df = read_data()
-
-    if model_type == "llama":
-        embed_model = load_embedding_model_local()
-        llm_code_model = load_code_model_local()
-        llm_model = load_llm_model_local()
-        load_service(llm_code_model, embed_model)
-        query_engine = create_dataframe_engine(df)
-    else:
+    if model_type != "llama":
         raise ValueError(f"{model_type} has not been implemented")
 
-    return {"query_engine": query_engine, "data": df, "llm_model": llm_model}
+    components = ["data", "embed_model", "code_model", "llm_model", "query_engine"]
+    if MODEL_ROUTING["enable"]:
+        components.insert(3, "small_code_model")
+    if warm_start:
+        components.append("warm_up")
+
+    data_and_model = {
+        "status": {
+            component: {"ready": False, "load_time": None, "error": None}
+            for component in components
+        },
+        "answer_cache": None,
+        "semantic_cache": None,
+        "plot_service": None,
+        "executor": None,
+        "model_locks": (
+            {"code_model": nullcontext(), "llm_model": nullcontext()}
+            if remote
+            else {"code_model": Lock(), "llm_model": Lock()}
+        ),
+        "summary_stats": {"calls": 0, "fallbacks": 0, "timeouts": 0},
+        "planner_stats": {"hits": 0, "misses": 0},
+        "job_queue": JobQueue() if JOB_QUEUE["enable"] else None,
+        "history": ConversationHistory(),
+        "dataset": DATASET_REGISTRY["default"],
+        "remote": remote,
+    }
+
+    loaders = {
+        "data": lambda: _read_dataset(data_and_model, DATASET_REGISTRY["default"]),
+        "embed_model": load_embedding_model_local,
+        "code_model": load_code_model_local,
+        "llm_model": load_llm_model_local,
+    }
+    if MODEL_ROUTING["enable"]:
+        loaders["small_code_model"] = load_small_code_model_local
+    if remote:
+        loaders["code_model"] = load_code_model_remote
+        loaders["llm_model"] = load_llm_model_remote
+        if MODEL_ROUTING["enable"]:
+            loaders["small_code_model"] = lambda: load_code_model_remote(
+                model="small_code_model"
+            )
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    jobs = [
+        executor.submit(_load_component, data_and_model, component, loader)
+        for component, loader in loaders.items()
+    ]
+
+    def _create_query_engine():
+        for job in jobs:
+            job.result()
+
+        if ANSWER_CACHE["enable"]:
+            data_and_model["answer_cache"] = AnswerCache()
+
+        if SEMANTIC_CACHE["enable"]:
+            data_and_model["semantic_cache"] = SemanticCache(
+                data_and_model["embed_model"]
+            )
+
+        load_service(data_and_model["code_model"], data_and_model["embed_model"])
+        register_llm_metrics()
+        return _create_dataset_engine(data_and_model, data_and_model)
+
+    query_engine_job = executor.submit(
+        _load_component, data_and_model, "query_engine", _create_query_engine
+    )
+
+    def _warm_up():
+        query_engine_job.result()
+        return warm_up(data_and_model)
+
+    warm_up_job = None
+    if warm_start:
+        warm_up_job = executor.submit(
+            _load_component, data_and_model, "warm_up", _warm_up
+        )
+    executor.shutdown(wait=False)
+
+    def _load_dataset(dataset: dict, name: str):
+        _load_component(dataset, "data", lambda: _read_dataset(dataset, name))
+        # the models are set up with the default dataset
+        query_engine_job.result()
+        if SEMANTIC_CACHE["enable"]:
+            dataset["semantic_cache"] = SemanticCache(data_and_model["embed_model"])
+        _load_component(
+            dataset,
+            "query_engine",
+            lambda: _create_dataset_engine(data_and_model, dataset),
+        )
+
+    data_and_model["datasets"] = DatasetRegistry(_load_dataset)
+
+    if not background:
+        query_engine_job.result()
+        if warm_up_job is not None:
+            warm_up_job.result()
+
+    return data_and_model